@@ -7,6 +7,9 @@
 Скрипт соберёт docker-образ (по умолчанию из ./docker/Dockerfile),
 а затем выполнит scripts/version.py realize внутри контейнера, монтируя
 pod-volume хоста в /runpod-volume.
+
+С флагом --in-process docker не используется: scripts/version.py realize
+выполняется в текущем процессе (например, уже внутри пода с ComfyUI).
 """
 
 from __future__ import annotations
@@ -14,6 +17,7 @@ from __future__ import annotations
 import argparse
 import os
 import pathlib
+import runpy
 import subprocess
 import sys
 import shutil
@@ -36,7 +40,15 @@ def _print_warn(message: str) -> None:
 def _run(cmd: List[str], *, cwd: pathlib.Path | None = None) -> None:
     _print_info("$ " + " ".join(cmd))
     try:
-        subprocess.run(cmd, cwd=str(cwd) if cwd else None, check=True)
+        # Вывод не перехватываем (без text=True); close_fds=False и stdin=DEVNULL
+        # позволяют CPython запускать docker через posix_spawn вместо fork/exec
+        subprocess.run(
+            cmd,
+            cwd=str(cwd) if cwd else None,
+            check=True,
+            close_fds=False,
+            stdin=subprocess.DEVNULL,
+        )
     except subprocess.CalledProcessError as exc:
         raise SystemExit(exc.returncode) from exc
     except FileNotFoundError as exc:
@@ -94,14 +106,6 @@ def run_realize_container(args: argparse.Namespace, image: str, version: str, ho
         f"{host_volume}:{container_volume}",
     ]
 
-    if host_volume != pathlib.Path("/runpod-volume"):
-        runpod-volume_path = host_volume
-    else:
-        runpod-volume_path = host_volume
-
-    if runpod-volume_path != container_volume:
-        cmd.extend(["-v", f"{host_volume}:/runpod-volume"])
-
     if args.env:
         for env_value in args.env:
             cmd.extend(["-e", env_value])
@@ -127,6 +131,29 @@ def run_realize_container(args: argparse.Namespace, image: str, version: str, ho
     _run(cmd)
 
 
+def run_realize_in_process(args: argparse.Namespace, version: str, host_volume: pathlib.Path, repo_root: pathlib.Path) -> int:
+    target_path = host_volume / "builds" / f"comfy-{version}"
+
+    os.environ["COMFY_VENV_MODE"] = args.venv_mode
+    for env_value in args.env or []:
+        key, sep, value = env_value.partition("=")
+        if not sep or not key:
+            raise SystemExit(f"[ERROR] Некорректный --env '{env_value}', ожидается KEY=VALUE")
+        os.environ[key] = value
+
+    argv: List[str] = ["realize", version, "--target", str(target_path)]
+    if args.models_dir:
+        argv.extend(["--models-dir", args.models_dir])
+    if args.offline:
+        argv.append("--offline")
+    if args.wheels_dir:
+        argv.extend(["--wheels-dir", args.wheels_dir])
+
+    _print_info("$ scripts/version.py " + " ".join(argv) + " (in-process)")
+    version_cli = runpy.run_path(str(repo_root / "scripts" / "version.py"), run_name="realize_version_cli")
+    return int(version_cli["main"](argv) or 0)
+
+
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Realize версии ComfyUI внутри docker-контейнера")
     parser.add_argument("version", help="Идентификатор версии (versions/<id>.json)")
@@ -142,6 +169,7 @@ def build_parser() -> argparse.ArgumentParser:
     parser.add_argument("--models-dir", help="Проброс --models-dir в scripts/version.py")
     parser.add_argument("--wheels-dir", help="Проброс --wheels-dir в scripts/version.py")
     parser.add_argument("--offline", action="store_true", help="Запустить realize c --offline")
+    parser.add_argument("--in-process", action="store_true", help="Выполнить realize в текущем процессе без docker build/run")
     return parser
 
 
@@ -153,6 +181,14 @@ def main(argv: list[str] | None = None) -> int:
     context_path = _resolve_path(repo_root, args.context)
     dockerfile_path = _resolve_path(context_path, args.dockerfile)
 
+    if args.in_process:
+        host_volume = _detect_volume_path()
+        _print_info(f"Подготовка версии {args.version} без docker")
+        code = run_realize_in_process(args, args.version, host_volume, repo_root)
+        if code == 0:
+            _print_info("Готово")
+        return code
+
     _require_executable("docker")
 
     _print_info(f"Сборка образа {args.image}")
@@ -4,7 +4,9 @@ from __future__ import annotations
 
 import os
 import pathlib
+from dataclasses import dataclass
 from functools import lru_cache
+from typing import Optional, Set, Tuple
 
 
 _CACHE_ROOT_ENV_VARS = (
@@ -29,82 +31,124 @@ _COMFY_CACHE_ENV = (
 )
 
 
-def _default_cache_root() -> pathlib.Path:
-    base_name = "runpod-comfy"
+def _detect_volume() -> Optional[pathlib.Path]:
     # Проверяем RunPod volume (приоритет /runpod-volume, затем /workspace)
-    for volume_path in [pathlib.Path("/runpod-volume"), pathlib.Path("/workspace")]:
+    for volume_path in (pathlib.Path("/runpod-volume"), pathlib.Path("/workspace")):
         if volume_path.exists() and os.access(str(volume_path), os.W_OK | os.X_OK):
-            return (volume_path / "cache" / base_name).resolve()
+            return volume_path.resolve()
+    return None
+
+
+# Volume определяется один раз при импорте, а не на первом вызове в горячем пути
+_DETECTED_VOLUME = _detect_volume()
+
+
+def _default_cache_root() -> pathlib.Path:
+    base_name = "runpod-comfy"
+    if _DETECTED_VOLUME is not None:
+        return _DETECTED_VOLUME / "cache" / base_name
 
     xdg = os.environ.get("XDG_CACHE_HOME")
     if xdg:
-        return pathlib.Path(xdg).expanduser().resolve() / base_name
+        return _abspath(xdg) / base_name
 
-    return pathlib.Path.home().expanduser().resolve() / ".cache" / base_name
+    return _abspath("~") / ".cache" / base_name
 
 
-@lru_cache(maxsize=1)
-def cache_root() -> pathlib.Path:
-    """Return the base directory for all shared caches."""
+def _abspath(value: str) -> pathlib.Path:
+    # Чистая строковая нормализация: в отличие от resolve() не делает lstat каждого предка
+    return pathlib.Path(os.path.abspath(os.path.expanduser(value)))
 
-    for env_name in _CACHE_ROOT_ENV_VARS:
+
+def _path_from_env(names: Tuple[str, ...]) -> Optional[pathlib.Path]:
+    for env_name in names:
         value = os.environ.get(env_name)
         if value:
-            return pathlib.Path(value).expanduser().resolve()
-    return _default_cache_root()
+            return _abspath(value)
+    return None
+
+
+@dataclass(frozen=True)
+class CachePaths:
+    """All shared cache directories, computed in a single pass over the environment."""
+
+    root: pathlib.Path
+    models: pathlib.Path
+    nodes: pathlib.Path
+    comfy: pathlib.Path
+    resolved: pathlib.Path
+    applied: pathlib.Path
+
+
+@lru_cache(maxsize=1)
+def paths() -> CachePaths:
+    """Return cache directories (env overrides are read once per process)."""
+
+    root = _path_from_env(_CACHE_ROOT_ENV_VARS) or _default_cache_root()
+    return CachePaths(
+        root=root,
+        models=_path_from_env(_MODELS_CACHE_ENV) or root / "models",
+        nodes=_path_from_env(_NODES_CACHE_ENV) or root / "custom_nodes",
+        comfy=_path_from_env(_COMFY_CACHE_ENV) or root / "comfy",
+        resolved=root / "resolved",
+        applied=root / "applied",
+    )
+
+
+# Directories already created by this process; set membership is GIL-atomic, so no lock
+_ENSURED_DIRS: Set[pathlib.Path] = set()
 
 
 def _ensure_dir(path: pathlib.Path) -> pathlib.Path:
-    path.mkdir(parents=True, exist_ok=True)
+    if path not in _ENSURED_DIRS:
+        os.makedirs(path, exist_ok=True)
+        _ENSURED_DIRS.add(path)
     return path
 
 
-@lru_cache(maxsize=1)
+def cache_root() -> pathlib.Path:
+    """Return the base directory for all shared caches."""
+
+    return paths().root
+
+
 def models_cache_dir() -> pathlib.Path:
     """Directory with cached model artifacts."""
 
-    for env_name in _MODELS_CACHE_ENV:
-        value = os.environ.get(env_name)
-        if value:
-            return _ensure_dir(pathlib.Path(value).expanduser().resolve())
-    return _ensure_dir(cache_root() / "models")
+    return _ensure_dir(paths().models)
 
 
-@lru_cache(maxsize=1)
 def nodes_cache_dir() -> pathlib.Path:
     """Directory with cached custom nodes checkouts."""
 
-    for env_name in _NODES_CACHE_ENV:
-        value = os.environ.get(env_name)
-        if value:
-            return _ensure_dir(pathlib.Path(value).expanduser().resolve())
-    return _ensure_dir(cache_root() / "custom_nodes")
+    return _ensure_dir(paths().nodes)
 
 
-@lru_cache(maxsize=1)
 def comfy_cache_dir() -> pathlib.Path:
     """Directory with cached ComfyUI core checkouts."""
 
-    for env_name in _COMFY_CACHE_ENV:
-        value = os.environ.get(env_name)
-        if value:
-            return _ensure_dir(pathlib.Path(value).expanduser().resolve())
-    return _ensure_dir(cache_root() / "comfy")
+    return _ensure_dir(paths().comfy)
 
 
-@lru_cache(maxsize=1)
 def resolved_cache_dir() -> pathlib.Path:
     """Directory for resolved version locks (metadata only)."""
 
-    return _ensure_dir(cache_root() / "resolved")
+    return _ensure_dir(paths().resolved)
+
+
+def applied_cache_dir() -> pathlib.Path:
+    """Directory with stamps of lock files that were applied successfully."""
+
+    return _ensure_dir(paths().applied)
 
 
 __all__ = [
+    "CachePaths",
+    "paths",
     "cache_root",
     "models_cache_dir",
     "nodes_cache_dir",
     "comfy_cache_dir",
     "resolved_cache_dir",
+    "applied_cache_dir",
 ]
-
-
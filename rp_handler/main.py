@@ -4,6 +4,7 @@ from __future__ import annotations
 import argparse
 import os
 import pathlib
+from functools import lru_cache
 from typing import Optional, Tuple
 
 from .resolver import (
@@ -12,20 +13,25 @@ from .resolver import (
     save_resolved_lock,
     realize_from_resolved,
 )
-from .output import emit_output
-from .workflow import run_workflow
-from .utils import validate_required_path
+from .output import emit_output, flush_pending
+from .utils import get_env_bool, validate_required_path
+
+
+# Корень репозитория разрешается один раз при импорте
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
 
 def _repo_root() -> pathlib.Path:
-    return pathlib.Path(__file__).resolve().parent.parent
+    return pathlib.Path(_REPO_ROOT)
 
 
+@lru_cache(maxsize=32)
 def spec_path_for_version(version_id: str) -> pathlib.Path:
     version = version_id.strip()
     if not version:
         raise ValueError("Empty version id")
-    return (_repo_root() / "versions" / f"{version}.json").resolve()
+    # _REPO_ROOT уже канонический — достаточно строковой нормализации вместо resolve()
+    return pathlib.Path(os.path.normpath(os.path.join(_REPO_ROOT, "versions", f"{version}.json")))
 
 
 def build_arg_parser() -> argparse.ArgumentParser:
@@ -51,6 +57,9 @@ def run_workflow_real(workflow_path: str, comfy_home: str, models_dir: str, verb
     validate_required_path(comfy_home, "ComfyUI home directory")
     validate_required_path(models_dir, "Models directory")
 
+    # Раннер (urllib, subprocess-обвязка ComfyUI) нужен только при реальном запуске
+    from .workflow import run_workflow
+
     return run_workflow(workflow_path, comfy_home, models_dir, verbose)
 
 
@@ -70,7 +79,7 @@ def main(argv: Optional[list[str]] = None) -> int:
         return 2
 
     # Offline behavior may be specified in spec.options.offline or env COMFY_OFFLINE
-    offline_env = str(os.environ.get("COMFY_OFFLINE", "")).strip().lower() in {"1", "true", "yes", "on"}
+    offline_env = get_env_bool("COMFY_OFFLINE")
     try:
         resolved = resolve_version_spec(spec_path, offline=offline_env)
     except SpecValidationError as exc:
@@ -112,6 +121,12 @@ def main(argv: Optional[list[str]] = None) -> int:
         verbose=args.verbose,
         extension=file_extension,
     )
+    # Дождаться фоновых загрузок в GCS до выхода
+    try:
+        flush_pending()
+    except RuntimeError as exc:
+        print(f"[ERROR] {exc}")
+        return 2
     return 0
 
 
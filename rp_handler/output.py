@@ -3,17 +3,90 @@ from __future__ import annotations
 
 import base64
 import datetime as dt
+import hashlib
+import io
 import os
+import random
+import sys
 import time
 import uuid
-from typing import Optional
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import IO, Dict, Optional, Set, Tuple
 
 from .utils import log_info, log_warn, get_env_bool
 
 
+# Размер чанка resumable-загрузки в GCS (кратен 256 KiB); 8 MiB вместо дефолтных
+# 256 KiB/100 MiB клиента — меньше round-trip'ов для крупных видео-артефактов
+_GCS_CHUNK_SIZE = int(os.environ.get("GCS_CHUNK_SIZE_MB", "8")) * 1024 * 1024
+
+# Загрузки в GCS идут в фоне: выгрузка артефакта перекрывается с дальнейшей работой,
+# ожидание — в flush_pending() перед завершением процесса
+_UPLOAD_POOL = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("GCS_UPLOAD_WORKERS", "4")),
+    thread_name_prefix="gcs-upload",
+)
+_PENDING: Dict[str, "Future[None]"] = {}
+
+# Объекты, уже загруженные этим процессом (для GCS_DEDUPE — без повторного exists())
+_UPLOADED: Set[str] = set()
+
+# Кусок исходных данных для потокового base64 (кратен 3 — без паддинга внутри потока)
+_B64_CHUNK = 3 * 1024 * 1024
+
+
+def _write_base64(data: bytes, stream: IO[bytes]) -> None:
+    """Записать base64 по кускам, не держа в памяти весь закодированный payload."""
+    view = memoryview(data)
+    for offset in range(0, len(view), _B64_CHUNK):
+        stream.write(base64.b64encode(view[offset:offset + _B64_CHUNK]))
+
+
+def _write_base64_text(data: bytes, stream: IO[str]) -> None:
+    """То же для текстового потока без .buffer (например, подменённый sys.stdout)."""
+    view = memoryview(data)
+    for offset in range(0, len(view), _B64_CHUNK):
+        stream.write(base64.b64encode(view[offset:offset + _B64_CHUNK]).decode("ascii"))
+
+
+def _gcs_storage():
+    """Модуль google.cloud.storage: после первого импорта берётся прямо из sys.modules."""
+    module = sys.modules.get("google.cloud.storage")
+    if module is None:
+        module = __import__("google.cloud.storage", fromlist=["Client"])  # type: ignore
+    return module
+
+
+@lru_cache(maxsize=4)
+def _gcs_client(project: Optional[str], creds_path: str, creds_mtime_ns: int):
+    """
+    Клиент GCS, переиспользуемый между вызовами (сохраняет HTTP-сессию и TLS-соединения).
+
+    mtime файла ключа входит в ключ кеша: при ротации credentials создаётся новый клиент.
+    """
+    return _gcs_storage().Client(project=project)  # uses GOOGLE_APPLICATION_CREDENTIALS
+
+
+# Хэндлы bucket и успешно проверенные bucket'ы — по (клиент, имя bucket)
+_BUCKETS: Dict[Tuple[object, str], object] = {}
+_VALIDATED: Set[Tuple[object, str]] = set()
+
+
+def _gcs_bucket(client, bucket_name: str):
+    key = (client, bucket_name)
+    bucket = _BUCKETS.get(key)
+    if bucket is None:
+        bucket = _BUCKETS[key] = client.bucket(bucket_name)
+    return bucket
+
+
 def _validate_gcs_permissions(client, bucket_name: str, verbose: bool) -> None:
+    key = (client, bucket_name)
+    if key in _VALIDATED:
+        return
     # Check bucket existence and basic permissions to create objects
-    bucket = client.bucket(bucket_name)
+    bucket = _gcs_bucket(client, bucket_name)
     try:
         # get_bucket throws on NotFound/Forbidden which is what we want to surface
         client.get_bucket(bucket_name)
@@ -27,6 +100,7 @@ def _validate_gcs_permissions(client, bucket_name: str, verbose: bool) -> None:
         # test_iam_permissions may be restricted; only warn if it fails unexpectedly
         if verbose:
             log_warn(f"Could not verify IAM permissions explicitly: {exc}")
+    _VALIDATED.add(key)
 
 
 def _infer_mime_type(extension: str) -> str:
@@ -65,21 +139,160 @@ def _infer_mime_type(extension: str) -> str:
     return mime_map.get(extension, "application/octet-stream")
 
 
+# HTTP-коды, при которых повтор загрузки имеет смысл (rate limit и 5xx)
+_RETRYABLE_HTTP_CODES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+def _is_retryable_gcs_error(exc: Exception) -> bool:
+    """Транзиентная ли ошибка: google.api_core исключения несут HTTP-код в .code."""
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    code = getattr(exc, "code", None)
+    return isinstance(code, int) and code in _RETRYABLE_HTTP_CODES
+
+
+def _retry_after_seconds(exc: Exception) -> Optional[float]:
+    """Значение заголовка Retry-After (в секундах), если сервер его прислал."""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return max(0.0, float(headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+
+def _do_upload(
+    blob,
+    data: bytes,
+    content_type: str,
+    verbose: bool,
+    skip_if_exists: bool = False,
+    metadata: Optional[Dict[str, str]] = None,
+) -> None:
+    """Загрузить объект с повторами, затем (опционально) выставить ACL и signed URL."""
+    # Content-addressed объект уже в bucket — повторно байты не гоним
+    if skip_if_exists:
+        try:
+            exists = blob.exists()
+        except Exception as exc:
+            exists = False
+            if verbose:
+                log_warn(f"exists() check failed for {blob.name}: {exc}; uploading")
+        if exists:
+            if verbose:
+                log_info(f"{blob.name} already uploaded; skipping")
+            _UPLOADED.add(blob.name)
+            # Объект мог быть загружен при другом GCS_PUBLIC — ACL и signed URL применяем и здесь
+            _finalize_object(blob, verbose)
+            return
+
+    if metadata:
+        blob.metadata = metadata
+
+    # Retry upload: truncated exponential backoff с полным jitter, только для транзиентных ошибок
+    max_attempts = int(os.environ.get("GCS_RETRIES", "3"))
+    base_sleep = float(os.environ.get("GCS_RETRY_BASE_SLEEP", "0.5"))
+    max_sleep = float(os.environ.get("GCS_RETRY_MAX_SLEEP", "32"))
+
+    # Верхние границы jitter-задержки для каждого повтора считаем заранее
+    caps = tuple(min(max_sleep, base_sleep * (1 << i)) for i in range(max(0, max_attempts - 1)))
+    upload = blob.upload_from_file
+
+    # Загружаем с правильным content_type; крупные объекты идут resumable-чанками
+    for attempt in range(1, max_attempts + 1):
+        started = time.monotonic()
+        try:
+            upload(io.BytesIO(data), size=len(data), content_type=content_type, rewind=True)
+            break
+        except Exception as exc:
+            elapsed = time.monotonic() - started
+            if not _is_retryable_gcs_error(exc):
+                raise RuntimeError(f"GCS upload failed: {exc}") from exc
+            if attempt >= max_attempts:
+                raise RuntimeError(f"GCS upload failed after {max_attempts} attempts: {exc}") from exc
+            sleep_s = _retry_after_seconds(exc)
+            if sleep_s is None:
+                sleep_s = random.uniform(0, caps[attempt - 1])
+            if verbose:
+                log_warn(f"upload attempt {attempt} failed after {elapsed:.2f}s: {exc}; retrying in {sleep_s:.1f}s")
+            time.sleep(sleep_s)
+
+    _UPLOADED.add(blob.name)
+    if verbose:
+        log_info(f"uploaded {blob.name}")
+    _finalize_object(blob, verbose)
+
+
+def _finalize_object(blob, verbose: bool) -> None:
+    """Выставить public-read ACL и/или сгенерировать signed URL — по GCS_PUBLIC / GCS_SIGNED_URL_TTL."""
+    # Optionally make object public
+    if get_env_bool("GCS_PUBLIC", False):
+        try:
+            blob.acl.all().grant_read()
+            blob.acl.save()
+        except Exception as exc:
+            if verbose:
+                log_warn(f"Failed to set public-read ACL: {exc}")
+
+    # Optionally generate a signed URL (logged in verbose mode)
+    signed_ttl = int(os.environ.get("GCS_SIGNED_URL_TTL", "0"))
+    if signed_ttl > 0:
+        try:
+            signed_url = blob.generate_signed_url(expiration=dt.timedelta(seconds=signed_ttl))
+            if verbose:
+                log_info(f"signed_url (ttl={signed_ttl}s): {signed_url}")
+        except Exception as exc:
+            if verbose:
+                log_warn(f"Failed to generate signed URL: {exc}")
+
+
+def flush_pending(timeout: Optional[float] = None) -> None:
+    """
+    Дождаться всех фоновых загрузок в GCS.
+
+    Args:
+        timeout: Общий таймаут ожидания в секундах (None — без ограничения)
+
+    Raises:
+        RuntimeError: Если хотя бы одна загрузка завершилась ошибкой
+    """
+    pending = dict(_PENDING)
+    _PENDING.clear()
+    if not pending:
+        return
+    names = {fut: name for name, fut in pending.items()}
+    errors = []
+    for fut in as_completed(names, timeout=timeout):
+        exc = fut.exception()
+        if exc is not None:
+            errors.append(f"{names[fut]}: {exc}")
+    if errors:
+        raise RuntimeError("GCS upload failed: " + "; ".join(errors))
+
+
 def emit_output(data: bytes, mode: str, out_file: Optional[str], gcs_bucket: Optional[str], gcs_prefix: Optional[str], verbose: bool, extension: str = ".bin") -> None:
     if mode == "base64":
-        payload = base64.b64encode(data).decode("utf-8")
         if out_file:
-            with open(out_file, "w", encoding="utf-8") as f:
-                f.write(payload)
+            with open(out_file, "wb") as f:
+                _write_base64(data, f)
             if verbose:
                 log_info(f"base64 saved to {out_file}")
         else:
-            print(payload)
+            stdout_buffer = getattr(sys.stdout, "buffer", None)
+            if stdout_buffer is None:
+                _write_base64_text(data, sys.stdout)
+                sys.stdout.write("\n")
+            else:
+                sys.stdout.flush()
+                _write_base64(data, stdout_buffer)
+                stdout_buffer.write(b"\n")
+                stdout_buffer.flush()
         return
 
     if mode == "gcs":
         try:
-            storage = __import__("google.cloud.storage", fromlist=["Client"])  # type: ignore
+            _gcs_storage()
         except Exception as exc:
             raise RuntimeError("google-cloud-storage is required for GCS output") from exc
 
@@ -88,77 +301,55 @@ def emit_output(data: bytes, mode: str, out_file: Optional[str], gcs_bucket: Opt
 
         # Credentials and project handling
         creds_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-        if not creds_path or not os.path.exists(creds_path):
+        try:
+            creds_mtime_ns = os.stat(creds_path).st_mtime_ns if creds_path else None
+        except OSError:
+            creds_mtime_ns = None
+        if creds_mtime_ns is None:
             raise RuntimeError("GOOGLE_APPLICATION_CREDENTIALS must point to a readable service-account JSON file")
         project = os.environ.get("GOOGLE_CLOUD_PROJECT") or os.environ.get("GCS_PROJECT")
-        client = storage.Client(project=project)  # uses GOOGLE_APPLICATION_CREDENTIALS
+        client = _gcs_client(project, creds_path, creds_mtime_ns)
 
         if get_env_bool("GCS_VALIDATE", True):
             _validate_gcs_permissions(client, gcs_bucket, verbose=verbose)
 
-        bucket = client.bucket(gcs_bucket)
+        bucket = _gcs_bucket(client, gcs_bucket)
         prefix = gcs_prefix or os.environ.get("GCS_PREFIX", "comfy/outputs")
-        timestamp = dt.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+        timestamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
         unique = uuid.uuid4().hex[:8]
         
         # Убедимся что extension начинается с точки
         if extension and not extension.startswith("."):
             extension = f".{extension}"
         
-        object_name = f"{prefix}/{timestamp}-{unique}{extension}"
+        # GCS_DEDUPE: имя объекта — хэш содержимого, одинаковые артефакты не грузятся повторно
+        dedupe = get_env_bool("GCS_DEDUPE", False)
+        if dedupe:
+            digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+            object_name = f"{prefix}/{digest}{extension}"
+        else:
+            object_name = f"{prefix}/{timestamp}-{unique}{extension}"
+        https_url = f"https://storage.googleapis.com/{gcs_bucket}/{object_name}"
+        if dedupe and (object_name in _PENDING or object_name in _UPLOADED):
+            print(https_url)
+            if verbose:
+                log_info(f"identical artifact already uploaded: {https_url}")
+            return
+
         blob = bucket.blob(object_name)
+        # Небольшие объекты клиент грузит одним multipart-запросом, крупные — resumable чанками
+        blob.chunk_size = _GCS_CHUNK_SIZE
         
         # Определяем content_type
         content_type = _infer_mime_type(extension)
 
-        # Retry upload with simple exponential backoff
-        max_attempts = int(os.environ.get("GCS_RETRIES", "3"))
-        base_sleep = float(os.environ.get("GCS_RETRY_BASE_SLEEP", "0.5"))
-        
-        # Загружаем с правильным content_type
-        last_exc: Optional[Exception] = None
-        for attempt in range(1, max_attempts + 1):
-            try:
-                blob.upload_from_string(data, content_type=content_type)
-                break
-            except Exception as exc:
-                last_exc = exc
-                if attempt < max_attempts:
-                    sleep_s = base_sleep * (2 ** (attempt - 1))
-                    if verbose:
-                        log_warn(f"upload attempt {attempt} failed: {exc}; retrying in {sleep_s:.1f}s")
-                    time.sleep(sleep_s)
-                else:
-                    raise RuntimeError(f"GCS upload failed after {max_attempts} attempts: {last_exc}") from last_exc
-
-        # Формируем публичный HTTPS URL
-        https_url = f"https://storage.googleapis.com/{gcs_bucket}/{object_name}"
-        
-        # Печатаем HTTPS URL вместо gs://
+        # Загрузка уходит в пул; URL печатаем сразу, чтобы сохранить порядок stdout
+        _PENDING[object_name] = _UPLOAD_POOL.submit(
+            _do_upload, blob, data, content_type, verbose, dedupe, {"sha": digest} if dedupe else None
+        )
         print(https_url)
         if verbose:
-            log_info(f"uploaded to {https_url} (gs://{gcs_bucket}/{object_name})")
-        
-        # Optionally make object public
-        if get_env_bool("GCS_PUBLIC", False):
-            try:
-                blob.acl.all().grant_read()
-                blob.acl.save()
-            except Exception as exc:
-                if verbose:
-                    log_warn(f"Failed to set public-read ACL: {exc}")
-
-        # Optionally generate a signed URL (logged in verbose mode)
-        signed_ttl = int(os.environ.get("GCS_SIGNED_URL_TTL", "0"))
-        signed_url: Optional[str] = None
-        if signed_ttl > 0:
-            try:
-                signed_url = blob.generate_signed_url(expiration=dt.timedelta(seconds=signed_ttl))
-                if verbose:
-                    log_info(f"signed_url (ttl={signed_ttl}s): {signed_url}")
-            except Exception as exc:
-                if verbose:
-                    log_warn(f"Failed to generate signed URL: {exc}")
+            log_info(f"upload started: {https_url} (gs://{gcs_bucket}/{object_name})")
         return
 
     raise ValueError(f"Unknown output mode: {mode}")
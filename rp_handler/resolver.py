@@ -1,17 +1,30 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
+import atexit
+import errno
+import hashlib
 import json
 import os
 import pathlib
+import re
+import shlex
 import shutil
+import stat
 import sys
 import tempfile
-from typing import Dict, List, Optional, Set, Tuple
-
-from .utils import log_info, log_warn, log_error, run_command, expand_env_vars
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from .utils import log_info, log_warn, log_error, run_command, run_command_tail, expand_env_vars, get_env_bool, json_dumps_pretty, json_loads as _json_loads
 from scripts import verify_models
 from rp_handler.cache import (
+    applied_cache_dir,
+    cache_root,
     nodes_cache_dir,
     comfy_cache_dir,
     resolved_cache_dir,
@@ -20,6 +33,25 @@ from rp_handler.cache import (
 
 _MODEL_FETCH_TIMEOUT = int(os.environ.get("COMFY_MODELS_TIMEOUT", "180"))
 
+# Число моделей, которые _prepare_models проверяет/скачивает одновременно
+_MODEL_WORKERS = int(os.environ.get("COMFY_MODEL_WORKERS", "4"))
+
+# Число параллельных pip-процессов для install_python_packages (1 = один общий вызов)
+_PIP_WORKERS = int(os.environ.get("COMFY_PIP_WORKERS", "1"))
+
+# Число параллельных git-процессов (ls-remote/clone) для кастом-нод
+_GIT_WORKERS = int(os.environ.get("COMFY_GIT_WORKERS", "8"))
+
+# Не повторять git fetch кеша ComfyUI чаще, чем раз в N секунд (если нужный commit уже есть — не нужен вовсе)
+_GIT_FETCH_TTL = int(os.environ.get("COMFY_GIT_FETCH_TTL", "600"))
+_FETCH_STAMP_NAME = ".git/runpod_last_fetch"
+
+# Параллельная выписка рабочего дерева ComfyUI (git checkout.workers, git >= 2.32; 0 — по числу CPU)
+_GIT_CHECKOUT_WORKERS = int(os.environ.get("COMFY_GIT_CHECKOUT_WORKERS", "0"))
+
+# Число параллельных проверок/загрузок моделей в verify_models.py (--workers)
+_VERIFY_WORKERS = int(os.environ.get("COMFY_VERIFY_WORKERS", "8"))
+
 
 # Функция expand_env удалена, используется expand_env_vars из utils
 
@@ -34,54 +66,59 @@ def expand_env(path: str, extra_env: Optional[Dict[str, str]] = None) -> str:
 
 def derive_env(models_dir: Optional[str]) -> Dict[str, str]:
     """Вычислить переменные окружения для ComfyUI."""
-    env: Dict[str, str] = {}
+    # Результат зависит только от models_dir и $COMFY_HOME — кешируем по обоим ключам
+    return dict(_derive_env_cached(models_dir, os.environ.get("COMFY_HOME")))
 
-    comfy_home = os.environ.get("COMFY_HOME")
-    if comfy_home:
-        env["COMFY_HOME"] = str(pathlib.Path(comfy_home).resolve())
-    else:
-        # Проверяем RunPod volume (приоритет /runpod-volume, затем /workspace)
-        for volume_path in [pathlib.Path("/runpod-volume"), pathlib.Path("/workspace")]:
-            if volume_path.exists():
-                env["COMFY_HOME"] = str((volume_path / "ComfyUI").resolve())
-                break
-        else:
-            env["COMFY_HOME"] = str(pathlib.Path("/runpod-volume/ComfyUI").resolve())
 
-    if models_dir:
-        env["MODELS_DIR"] = str(pathlib.Path(models_dir).resolve())
-    else:
-        # Проверяем RunPod volume (приоритет /runpod-volume, затем /workspace)
-        for volume_path in [pathlib.Path("/runpod-volume"), pathlib.Path("/workspace")]:
-            if volume_path.exists():
-                env["MODELS_DIR"] = str((volume_path / "models").resolve())
-                break
-        else:
-            env["MODELS_DIR"] = str(pathlib.Path("/runpod-volume/models").resolve())
+@lru_cache(maxsize=4)
+def _derive_env_cached(models_dir: Optional[str], comfy_home: Optional[str]) -> Dict[str, str]:
+    volume: Optional[str] = None
+    if not comfy_home or not models_dir:
+        # Проверяем RunPod volume (приоритет /runpod-volume, затем /workspace) — один проход на оба значения
+        volume = next((v for v in ("/runpod-volume", "/workspace") if os.path.exists(v)), "/runpod-volume")
+
+    realpath = os.path.realpath
+    return {
+        "COMFY_HOME": realpath(comfy_home) if comfy_home else realpath(os.path.join(volume, "ComfyUI")),
+        "MODELS_DIR": realpath(models_dir) if models_dir else realpath(os.path.join(volume, "models")),
+    }
+
+
+@lru_cache(maxsize=64)
+def _read_json_cached(path_str: str, mtime_ns: int, size: int) -> Dict[str, object]:
+    """Разбор JSON-файла; ключ (путь, mtime_ns, размер) инвалидирует кеш при изменении файла.
 
-    return env
+    Результат общий для всех вызывающих — его нельзя мутировать.
+    """
+    return _json_loads(pathlib.Path(path_str).read_bytes())  # type: ignore[return-value]
 
 
 def load_lock(path: Optional[str]) -> Dict[str, object]:
-    """Загрузить lock-файл."""
+    """Загрузить lock-файл (повторные вызовы без изменения файла берутся из кеша)."""
     if not path:
         log_warn("No lock file path provided; continuing with minimal setup")
         return {}
     
     lock_path = pathlib.Path(path)
-    if not lock_path.exists():
+    try:
+        st = lock_path.stat()
+    except FileNotFoundError:
         log_warn(f"Lock file not found: {lock_path}")
         return {}
-    
+    except OSError as e:
+        log_error(f"Failed to load lock file {lock_path}: {e}")
+        return {}
+
     try:
-        data = json.loads(lock_path.read_text(encoding="utf-8"))
-        return data
-    except (json.JSONDecodeError, OSError) as e:
+        return _read_json_cached(str(lock_path), st.st_mtime_ns, st.st_size)
+    except (ValueError, OSError) as e:
         log_error(f"Failed to load lock file {lock_path}: {e}")
         return {}
 
 
+@lru_cache(maxsize=1)
 def _select_python_executable() -> str:
+    # PATH не меняется в пределах процесса — поиск через shutil.which делаем один раз
     # Предпочитаем "python3", затем "python", затем sys.executable
     for cand in ("python3", "python"):
         found = shutil.which(cand)
@@ -90,86 +127,217 @@ def _select_python_executable() -> str:
     return sys.executable
 
 
-def install_python_packages(lock: Dict[str, object], verbose: bool) -> None:
-    """Установить Python пакеты согласно lock-файлу."""
+def _canonical_dist_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _installed_distributions() -> Dict[str, str]:
+    """Снимок установленных в текущем интерпретере дистрибутивов: имя -> версия."""
+    from importlib import metadata
+
+    installed: Dict[str, str] = {}
+    for dist in metadata.distributions():
+        name = dist.metadata["Name"]
+        if name:
+            installed.setdefault(_canonical_dist_name(name), dist.version)
+    return installed
+
+
+def _is_current_interpreter(python_exe: str) -> bool:
+    # Сравниваем пути без resolve(): python из venv — симлинк на базовый, но окружение другое
+    return os.path.abspath(python_exe) == os.path.abspath(sys.executable)
+
+
+def _lock_package_spec(item: Dict[str, object], installed: Dict[str, str]) -> Optional[str]:
+    """Строка требования pip для записи python.packages; None — если ставить не нужно."""
+    name = str(item.get("name") or "")
+    url = item.get("url")
+    if url:
+        return f"{name} @ {url}"
+    ver = item.get("version")
+    have = installed.get(_canonical_dist_name(name)) if name and installed else None
+    if ver:
+        return None if have == str(ver) else f"{name}=={ver}"
+    if name and have is None:
+        return name
+    return None
+
+
+@lru_cache(maxsize=1)
+def _uv_executable() -> Optional[str]:
+    """Путь к uv, если он есть в PATH и не отключён через COMFY_USE_UV=0."""
+    if not get_env_bool("COMFY_USE_UV", True):
+        return None
+    return shutil.which("uv")
+
+
+def _pip_install_cmd(python_interpreter: str) -> List[str]:
+    """Базовая команда установки: uv pip (быстрый резолвер, без bootstrap pip) либо python -m pip."""
+    uv = _uv_executable()
+    # uv ставит только в venv (системный/externally-managed python требует --system);
+    # venv опознаём по pyvenv.cfg рядом с bin/
+    venv_cfg = os.path.join(os.path.dirname(os.path.dirname(python_interpreter)), "pyvenv.cfg")
+    if uv and os.path.isfile(venv_cfg):
+        return [uv, "pip", "install", "--python", python_interpreter]
+    return [python_interpreter, "-m", "pip", "install"]
+
+
+def _pip_install_requirements(base_args: List[str], specs: List[str], *, capture: bool = True) -> Tuple[int, str, str]:
+    """Передать спецификации pip через временный requirements-файл (-r) вместо argv."""
+    with tempfile.NamedTemporaryFile(
+        "w", suffix=".txt", prefix="lock_requirements_", delete=False, encoding="utf-8"
+    ) as tmp:
+        tmp.write("\n".join(specs) + "\n")
+    try:
+        return run_command(base_args + ["-r", tmp.name], capture=capture)
+    finally:
+        try:
+            os.remove(tmp.name)
+        except OSError:
+            pass
+
+
+def install_python_packages(lock: Dict[str, object], verbose: bool) -> bool:
+    """Установить Python пакеты согласно lock-файлу. Возвращает False, если pip завершился с ошибкой."""
     python = lock.get("python") if isinstance(lock, dict) else None
     if not isinstance(python, dict):
         log_warn("No python section in lock; skipping packages install")
-        return
+        return True
     
     packages = python.get("packages")
     if not isinstance(packages, list) or not packages:
         log_warn("Empty python.packages; skipping")
-        return
+        return True
     
     # Выбор интерпретера Python
     python_interpreter: str = _resolve_python_interpreter(lock, verbose=verbose)
 
-    # Составление аргументов pip install
-    args: List[str] = [python_interpreter, "-m", "pip", "install"]
-    for item in packages:
-        if not isinstance(item, dict):
-            continue
-        name = str(item.get("name") or "")
-        url = item.get("url")
-        ver = item.get("version")
-        if url:
-            args.append(f"{name} @ {url}")
-        elif ver:
-            args.append(f"{name}=={ver}")
-        elif name:
-            args.append(name)
-    
-    if verbose:
-        log_info("pip install: " + " ".join(args[4:]))
-    
-    code, out, err = run_command(args)
-    if code != 0:
-        log_warn(f"pip install returned {code}: {err}")
-    elif verbose:
-        log_info(out)
+    # Если ставим в текущий интерпретер — сверяемся с уже установленными дистрибутивами
+    installed = _installed_distributions() if _is_current_interpreter(python_interpreter) else {}
 
+    # Составление списка пакетов для pip install (одним проходом, без промежуточных списков)
+    specs: List[str] = [
+        spec
+        for spec in (_lock_package_spec(item, installed) for item in packages if isinstance(item, dict))
+        if spec
+    ]
 
-def verify_and_fetch_models(lock_path: Optional[str], env: Dict[str, str], verbose: bool, no_cache: bool = False) -> None:
-    """Проверить и загрузить модели согласно lock-файлу."""
-    if not lock_path:
-        return
+    if not specs:
+        log_info("python.packages уже установлены; pip пропущен")
+        return True
 
-    # Поиск скрипта verify_models.py
-    possible_paths = [
-        pathlib.Path("/app/scripts/verify_models.py"),
-        pathlib.Path(__file__).parent.parent / "scripts" / "verify_models.py",
-        pathlib.Path.cwd() / "scripts" / "verify_models.py",
-    ]
+    if verbose:
+        log_info("pip install: " + " ".join(specs))
 
-    script_path = None
-    for path in possible_paths:
-        if path.exists():
-            script_path = path
-            break
+    workers = max(1, min(len(specs), _PIP_WORKERS))
+    if workers == 1:
+        code, out, err = _pip_install_requirements(
+            _pip_install_cmd(python_interpreter), specs, capture=verbose
+        )
+        if code != 0:
+            log_warn(f"pip install returned {code}: {err}")
+            return False
+        if verbose:
+            log_info(out)
+        return True
+
+    # Lock фиксирует точные версии/URL, поэтому ставим с --no-deps, чтобы параллельные
+    # pip не конкурировали за резолвинг зависимостей. URL-колёса независимы — каждое
+    # отдельной задачей; пакеты name==ver шардируем по воркерам
+    base_args = _pip_install_cmd(python_interpreter) + ["--no-deps"]
+    url_specs = [spec for spec in specs if " @ " in spec]
+    named_specs = [spec for spec in specs if " @ " not in spec]
+    shards = max(1, min(len(named_specs), workers))
+    chunks = [[spec] for spec in url_specs] + [
+        named_specs[idx::shards] for idx in range(shards) if named_specs[idx::shards]
+    ]
+    ok = True
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        future_to_chunk = {
+            executor.submit(_pip_install_requirements, base_args, chunk, capture=verbose): chunk
+            for chunk in chunks
+        }
+        for future in as_completed(future_to_chunk):
+            chunk = future_to_chunk[future]
+            code, out, err = future.result()
+            if code != 0:
+                log_warn(f"pip install returned {code} for {' '.join(chunk)}: {err}")
+                ok = False
+            elif verbose:
+                log_info(out)
+    return ok
+
+
+def verify_and_fetch_models(lock_path: Optional[str], env: Dict[str, str], verbose: bool, no_cache: bool = False) -> bool:
+    """Проверить и загрузить модели согласно lock-файлу. Возвращает True, если все модели в порядке."""
+    if not lock_path:
+        return True
 
-    if not script_path:
-        log_warn("verify_models.py not found; skipping model verification")
-        return
-    
-    # Выбор Python интерпретера
-    python_exe = _venv_python_from_env() or _select_python_executable()
-    
-    # Составление аргументов
+    # verify_models уже импортирован — вызываем его CLI-точку входа в процессе, без запуска python
     args = [
-        python_exe, str(script_path), 
-        "--lock", str(lock_path), 
-        "--models-dir", env["MODELS_DIR"], 
-        "--verbose"
+        "--lock", str(lock_path),
+        "--models-dir", env["MODELS_DIR"],
+        "--workers", str(max(1, _VERIFY_WORKERS)),
     ]
+    # Построчный статус моделей нужен только в verbose-режиме
+    if verbose:
+        args.append("--verbose")
     if not no_cache:
         args.append("--cache")
-    
-    code, out, err = run_command(args)
+
+    code = verify_models.main(args)
     if code != 0:
-        log_warn(f"verify_models failed ({code}): {err}")
-    elif verbose:
-        log_info(out)
+        log_warn(f"verify_models failed ({code})")
+        return False
+    return True
+
+
+# Версия Python и pip целевого интерпретатора одним запуском (pip не импортируется)
+_TOOLCHAIN_PROBE_SCRIPT = (
+    "import sys\n"
+    "from importlib import metadata\n"
+    "try:\n"
+    "    pip = metadata.version('pip')\n"
+    "except metadata.PackageNotFoundError:\n"
+    "    pip = 'none'\n"
+    "print(sys.version.replace(chr(10), ' '))\n"
+    "print('pip ' + pip)\n"
+)
+
+
+@lru_cache(maxsize=8)
+def _toolchain_fingerprint(python_interpreter: str) -> str:
+    """Версия Python целевого интерпретатора и установщика (uv или его pip), которым ставится lock."""
+    base_cmd = _pip_install_cmd(python_interpreter)
+    code, out, err = run_command([python_interpreter, "-c", _TOOLCHAIN_PROBE_SCRIPT])
+    parts = [out if code == 0 else f"unknown python {python_interpreter}"]
+    if base_cmd[0] != python_interpreter:
+        # Ставит uv — значима его версия
+        code, out, err = run_command([base_cmd[0], "--version"])
+        parts.append(out if code == 0 else f"unknown {base_cmd[0]}")
+    return "\0".join(parts)
+
+
+def _stamp_interpreter(lock: Dict[str, object], env: Dict[str, str]) -> str:
+    """Интерпретер, в который install_python_packages поставит пакеты, — без создания venv."""
+    return (
+        _select_python_from_lock(lock)
+        or _check_venv(env["COMFY_HOME"])
+        or _select_python_executable()
+    )
+
+
+def _applied_stamp_path(lock_path: str, env: Dict[str, str], python_interpreter: str) -> Optional[pathlib.Path]:
+    """Путь штампа применённого lock: sha256 содержимого lock + целевые каталоги + тулчейн."""
+    try:
+        lock_bytes = pathlib.Path(lock_path).read_bytes()
+    except OSError:
+        return None
+    digest = hashlib.sha256(lock_bytes)
+    digest.update(f"\0{env['COMFY_HOME']}\0{env['MODELS_DIR']}".encode("utf-8"))
+    # Смена версии Python целевого интерпретатора или установщика (uv/pip) инвалидирует штамп
+    digest.update(f"\0{python_interpreter}\0{_toolchain_fingerprint(python_interpreter)}".encode("utf-8"))
+    return applied_cache_dir() / f"{digest.hexdigest()}.stamp"
 
 
 def apply_lock_and_prepare(lock_path: Optional[str], models_dir: Optional[str], verbose: bool) -> None:
@@ -179,35 +347,62 @@ def apply_lock_and_prepare(lock_path: Optional[str], models_dir: Optional[str],
     # Экспорт переменных в окружение процесса
     os.environ["COMFY_HOME"] = env["COMFY_HOME"]
     os.environ["MODELS_DIR"] = env["MODELS_DIR"]
-    
+
     lock = load_lock(lock_path)
-    
-    # 1) Установить Python пакеты согласно lock
-    install_python_packages(lock, verbose=verbose)
-    
-    # 2) Проверить/восстановить модели
-    if lock_path:
-        # Включение кэша только если явно запрошено через env
-        use_cache = (
-            (os.environ.get("COMFY_ENABLE_CACHE", "").lower() in ("1", "true", "yes"))
-            or (os.environ.get("COMFY_CACHE", "").lower() in ("1", "true", "yes"))
-        )
-        verify_and_fetch_models(lock_path=lock_path, env=env, verbose=verbose, no_cache=(not use_cache))
+
+    # Тот же lock уже успешно применён к этим каталогам — пропускаем pip и проверку моделей
+    stamp = _applied_stamp_path(lock_path, env, _stamp_interpreter(lock, env)) if lock_path else None
+    if stamp is not None and not get_env_bool("COMFY_FORCE_PREPARE"):
+        try:
+            if stamp.stat().st_mtime >= pathlib.Path(lock_path).stat().st_mtime:
+                log_info(f"Lock {lock_path} уже применён ({stamp.name}); пропускаю установку")
+                return
+        except OSError:
+            pass
+
+    # Установка пакетов (site-packages) и проверка моделей (MODELS_DIR) не пересекаются
+    # по файлам — выполняем их параллельно, время ≈ max вместо суммы
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        # 1) Установить Python пакеты согласно lock
+        packages_future = executor.submit(install_python_packages, lock, verbose)
+
+        # 2) Проверить/восстановить модели
+        models_future = None
+        if lock_path:
+            # Включение кэша только если явно запрошено через env
+            use_cache = any(get_env_bool(name) for name in ("COMFY_ENABLE_CACHE", "COMFY_CACHE"))
+            models_future = executor.submit(
+                verify_and_fetch_models, lock_path=lock_path, env=env, verbose=verbose, no_cache=(not use_cache)
+            )
+
+        packages_ok = packages_future.result()
+        models_ok = models_future.result() if models_future is not None else True
+
+    if stamp is not None and packages_ok and models_ok:
+        # Установка могла создать venv или обновить pip/uv — штамп считаем по итоговому тулчейну
+        _toolchain_fingerprint.cache_clear()
+        stamp = _applied_stamp_path(lock_path, env, _stamp_interpreter(lock, env))
+        try:
+            stamp.touch()
+        except OSError as exc:
+            log_warn(f"Не удалось записать штамп применённого lock {stamp}: {exc}")
 
 
 # ------------------------- New version resolve/realize API ------------------------- #
 
+@lru_cache(maxsize=1)
 def _repo_root() -> pathlib.Path:
     return pathlib.Path(__file__).resolve().parent.parent
 
 
 def _read_json(path: pathlib.Path) -> Dict[str, object]:
-    return json.loads(path.read_text(encoding="utf-8"))
+    st = os.stat(path)
+    return _read_json_cached(str(path), st.st_mtime_ns, st.st_size)
 
 
 def _safe_write_json(path: pathlib.Path, data: Dict[str, object]) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_text(json.dumps(data, ensure_ascii=False, indent=2, sort_keys=True) + "\n", encoding="utf-8")
+    path.write_bytes(json_dumps_pretty(data, sort_keys=True))
 
 
 def _slug_from_repo(repo_url: str) -> str:
@@ -232,6 +427,27 @@ def _git_ls_remote(repo: str, ref: Optional[str]) -> Optional[str]:
     return None
 
 
+def _git_ls_remote_many(pairs: List[Tuple[str, Optional[str]]]) -> Dict[Tuple[str, Optional[str]], Optional[str]]:
+    """Резолв нескольких (repo, ref) параллельно: ls-remote упирается в сетевой RTT, а не в CPU."""
+    unique = list(dict.fromkeys(pairs))
+    if not unique:
+        return {}
+    workers = max(1, min(len(unique), _GIT_WORKERS))
+    if workers == 1:
+        return {pair: _git_ls_remote(*pair) for pair in unique}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(unique, executor.map(lambda pair: _git_ls_remote(*pair), unique)))
+
+
+@lru_cache(maxsize=4)
+def _accessible_volume(mode: int) -> Optional[pathlib.Path]:
+    """Первый доступный RunPod volume (приоритет /runpod-volume, затем /workspace); проба раз на процесс."""
+    for volume_path in (pathlib.Path("/runpod-volume"), pathlib.Path("/workspace")):
+        if volume_path.exists() and os.access(str(volume_path), mode):
+            return volume_path
+    return None
+
+
 def _pick_default_comfy_home(version_id: str) -> pathlib.Path:
     env_home_raw = os.environ.get("COMFY_HOME")
     default_env_home = "/runpod-volume/ComfyUI"
@@ -243,10 +459,10 @@ def _pick_default_comfy_home(version_id: str) -> pathlib.Path:
             return env_home
 
     # Проверяем RunPod volume (приоритет /runpod-volume, затем /workspace)
-    for volume_path in [pathlib.Path("/runpod-volume"), pathlib.Path("/workspace")]:
-        if volume_path.exists() and os.access(str(volume_path), os.W_OK | os.X_OK):
-            builds_root = volume_path / "builds"
-            return (builds_root / f"comfy-{version_id}").resolve()
+    volume_path = _accessible_volume(os.W_OK | os.X_OK)
+    if volume_path is not None:
+        builds_root = volume_path / "builds"
+        return (builds_root / f"comfy-{version_id}").resolve()
 
     # Если volume недоступен, используем env-значение (даже дефолтное)
     if env_home_raw:
@@ -278,9 +494,9 @@ def _models_dir_default(comfy_home: pathlib.Path) -> pathlib.Path:
         return pathlib.Path(env_models)
     
     # Попытка определить volume root (приоритет /runpod-volume, затем /workspace)
-    for volume_path in [pathlib.Path("/runpod-volume"), pathlib.Path("/workspace")]:
-        if volume_path.exists() and os.access(str(volume_path), os.R_OK):
-            return volume_path / "models"
+    volume_path = _accessible_volume(os.R_OK)
+    if volume_path is not None:
+        return volume_path / "models"
     
     # Fallback: рядом с comfy_home, если comfy_home на volume
     if comfy_home.parts[:2] in [("/", "runpod-volume"), ("/", "workspace")]:
@@ -289,7 +505,35 @@ def _models_dir_default(comfy_home: pathlib.Path) -> pathlib.Path:
     return comfy_home / "models"
 
 
-def _ensure_repo_cache(repo: str, *, offline: bool) -> pathlib.Path:
+# (кеш-репозиторий, commit), наличие которых уже подтверждено: объекты из репозитория не исчезают
+_KNOWN_COMMITS: Set[Tuple[str, str]] = set()
+
+
+def _commit_in_cache(cache_path: pathlib.Path, commit: str) -> bool:
+    """Есть ли commit в кеш-репозитории (положительный ответ запоминается — без повторного git)."""
+    key = (str(cache_path), commit)
+    if key in _KNOWN_COMMITS:
+        return True
+    code, _, _ = run_command(["git", "-C", str(cache_path), "cat-file", "-e", f"{commit}^{{commit}}"])
+    if code != 0:
+        return False
+    _KNOWN_COMMITS.add(key)
+    return True
+
+
+def _repo_cache_is_current(cache_path: pathlib.Path, commit: Optional[str]) -> bool:
+    """Актуален ли кеш: известный commit уже скачан; без commit — последний fetch был недавно (TTL)."""
+    if commit:
+        # Новый pin нужно докачать даже внутри TTL
+        return _commit_in_cache(cache_path, commit)
+    try:
+        age = time.time() - (cache_path / _FETCH_STAMP_NAME).stat().st_mtime
+    except OSError:
+        return False
+    return age < _GIT_FETCH_TTL
+
+
+def _ensure_repo_cache(repo: str, *, offline: bool, commit: Optional[str] = None) -> pathlib.Path:
     cache_root = _comfy_cache_root()
     cache_root.mkdir(parents=True, exist_ok=True)
     cache_path = cache_root / _slug_from_repo(repo)
@@ -300,39 +544,81 @@ def _ensure_repo_cache(repo: str, *, offline: bool) -> pathlib.Path:
             raise RuntimeError(
                 f"Offline режим: отсутствует кеш репозитория {repo}, требуется предварительная синхронизация"
             )
-        code, out, err = run_command(["git", "clone", repo, str(cache_path)])
-        if code != 0:
-            raise RuntimeError(f"Не удалось клонировать репозиторий {repo}: {err or out}")
+        # Commit известен — качаем только его (depth=1), без истории и остальных веток/тегов
+        if not (commit and _is_full_sha(commit) and _shallow_fetch_commit(repo, commit, cache_path, init=True, pin=True)):
+            code, out, err = run_command_tail(["git", "clone", repo, str(cache_path)])
+            if code != 0:
+                raise RuntimeError(f"Не удалось клонировать репозиторий {repo}: {err or out}")
         log_info(f"[resolver] репозиторий {repo} успешно клонирован в {cache_path}")
     elif not offline:
+        if _repo_cache_is_current(cache_path, commit):
+            log_info(f"[resolver] кеш репозитория {repo} актуален, fetch пропущен")
+            return cache_path
+        if commit and _is_full_sha(commit) and _shallow_fetch_commit(repo, commit, cache_path, init=False, pin=True):
+            log_info(f"[resolver] commit {commit[:12]} добавлен в кеш репозитория {repo}")
+            return cache_path
         log_info(f"[resolver] обновляю кеш репозитория {repo} в {cache_path}")
-        run_command(["git", "-C", str(cache_path), "fetch", "--all", "--tags", "-q"])
+        code, _, _ = run_command(["git", "-C", str(cache_path), "fetch", "--all", "--tags", "-q"])
+        if code == 0:
+            try:
+                (cache_path / _FETCH_STAMP_NAME).touch()
+            except OSError:
+                pass
 
     return cache_path
 
 
+def _discard_tree(path: pathlib.Path) -> None:
+    """Убрать каталог с пути мгновенно (rename), а удалить содержимое в фоновом потоке.
+
+    Заодно подчищаются оставшиеся от прошлых запусков <name>.trash.* рядом с ним.
+    """
+    leftovers = list(path.parent.glob(f"{path.name}.trash.*"))
+    _VENV_PYTHONS.pop(str(path), None)  # venv уходит вместе с каталогом
+    trash = path.with_name(f"{path.name}.trash.{os.getpid()}.{time.time_ns()}")
+    try:
+        os.rename(path, trash)
+    except OSError:
+        shutil.rmtree(path)
+    else:
+        leftovers.append(trash)
+    if leftovers:
+        threading.Thread(target=_rmtree_all, args=(leftovers,), name="discard-tree", daemon=True).start()
+
+
+def _rmtree_all(paths: List[pathlib.Path]) -> None:
+    for trash_path in paths:
+        shutil.rmtree(trash_path, ignore_errors=True)
+
+
 def _checkout_from_cache(
     *,
     cache_repo: pathlib.Path,
     target_repo: pathlib.Path,
     commit: Optional[str],
     offline: bool,
+    keep: Tuple[pathlib.Path, ...] = (),
 ) -> None:
+    """Выписать commit из кеша в target_repo. keep — каталоги внутри target_repo, которые git clean не трогает."""
     if target_repo.exists() and not (target_repo / ".git").exists():
-        shutil.rmtree(target_repo)
+        _discard_tree(target_repo)
 
+    freshly_cloned = False
     if not target_repo.exists():
         target_repo.parent.mkdir(parents=True, exist_ok=True)
         log_info(f"[resolver] создаю рабочую копию из {cache_repo} в {target_repo}")
         clone_args = ["git", "clone", "--shared", str(cache_repo), str(target_repo)]
-        code, out, err = run_command(clone_args)
+        if commit:
+            # Рабочее дерево всё равно переключим на commit — не выписываем HEAD зря
+            clone_args.insert(2, "--no-checkout")
+        code, out, err = run_command_tail(clone_args)
         if code != 0:
             raise RuntimeError(f"Не удалось подготовить рабочую копию ComfyUI: {err or out}")
+        freshly_cloned = True
 
     # Убедиться, что commit присутствует в кешовом репозитории
     if commit:
-        code, _, _ = run_command(["git", "-C", str(cache_repo), "cat-file", "-e", f"{commit}^{{commit}}"])
-        if code != 0:
+        if not _commit_in_cache(cache_repo, commit):
             if offline:
                 raise RuntimeError(
                     f"Offline режим: коммит {commit} отсутствует в кешовом репозитории {cache_repo}"
@@ -340,19 +626,46 @@ def _checkout_from_cache(
             raise RuntimeError(f"Коммит {commit} отсутствует в кешовом репозитории {cache_repo}")
         log_info(f"[resolver] commit {commit} найден в кеше {cache_repo}")
 
-    # Обновить локальную копию из кеша (без обращения в сеть)
-    if commit:
-        log_info(f"[resolver] синхронизирую {target_repo} с кешем {cache_repo} и переключаюсь на {commit}")
-        run_command(["git", "-C", str(target_repo), "remote", "set-url", "origin", str(cache_repo)])
-        run_command(["git", "-C", str(target_repo), "fetch", "origin", "--tags", "-q"])
-
     checkout_target = commit or "HEAD"
-    log_info(f"[resolver] checkout --force {checkout_target} в {target_repo}")
-    code, out, err = run_command(["git", "-C", str(target_repo), "checkout", "--force", checkout_target])
+    target = str(target_repo)
+    # Объекты --shared клон берёт из кеша через alternates; остаётся запись файлов дерева — её распараллеливаем
+    checkout_workers = f"checkout.workers={_GIT_CHECKOUT_WORKERS}"
+
+    if freshly_cloned:
+        # Свежий клон уже содержит всё из кеша и не имеет локальных изменений — только checkout
+        log_info(f"[resolver] checkout --force {checkout_target} в {target_repo}")
+        code, out, err = run_command(
+            ["git", "-C", target, "-c", checkout_workers, "checkout", "--force", checkout_target]
+        )
+    else:
+        # Существующая копия: синхронизация с кешем (без обращения в сеть), checkout и очистка
+        # от локальных изменений — одним процессом sh вместо пяти отдельных запусков git.
+        # Как и раньше, фатальна только ошибка checkout
+        log_info(f"[resolver] синхронизирую {target_repo} с кешем {cache_repo} и переключаюсь на {checkout_target}")
+        git = f"git -C {shlex.quote(target)}"
+        ref = shlex.quote(checkout_target)
+        steps = []
+        if commit:
+            # Синхронизация с кешем — только если commit ещё нет в рабочей копии.
+            # --update-shallow: кеш может быть shallow (commit'ы скачаны с depth=1)
+            steps.append(
+                f"{git} cat-file -e {ref}^{{commit}} 2>/dev/null || "
+                f"{{ {git} remote set-url origin {shlex.quote(str(cache_repo))}; "
+                f"{git} fetch --update-shallow origin --tags -q; }}"
+            )
+        steps.append(f"{git} -c {checkout_workers} checkout --force {ref} || exit $?")
+        steps.append(f"{git} reset --hard {ref}")
+        # venv/модели внутри рабочей копии — gitignored: clean -x их не обходит и не удаляет
+        clean = f"{git} clean -fdx"
+        for path in keep:
+            rel = os.path.relpath(path, target)
+            if rel != "." and not rel.startswith(".."):
+                clean += f" -e {shlex.quote('/' + rel.replace(os.sep, '/') + '/')}"
+        steps.append(clean)
+        steps.append("exit 0")
+        code, out, err = run_command(["sh", "-c", "; ".join(steps)])
     if code != 0:
         raise RuntimeError(f"Не удалось переключиться на {checkout_target} в {target_repo}: {err or out}")
-    run_command(["git", "-C", str(target_repo), "reset", "--hard", checkout_target])
-    run_command(["git", "-C", str(target_repo), "clean", "-fdx"])
     log_info(f"[resolver] рабочая копия {target_repo} готова к использованию")
 
 
@@ -371,136 +684,305 @@ def _ensure_symlink(src: pathlib.Path, dst: pathlib.Path) -> None:
         pass
 
 
-def _install_custom_node_dependencies(
-    *,
-    python_exe: str,
-    comfy_home: pathlib.Path,
-    wheels_dir: Optional[pathlib.Path],
-    offline: bool,
-) -> None:
-    if offline:
-        return
+# Ошибки os.link, при которых вместо жёсткой ссылки создаётся симлинк
+_HARDLINK_FALLBACK_ERRNOS = frozenset({errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP})
+
+
+def _link_model(src: pathlib.Path, dst: pathlib.Path) -> str:
+    """
+    Подключить файл модели по пути dst: жёсткой ссылкой, если src на той же ФС, иначе симлинком.
+    
+    Жёсткая ссылка — тот же inode, без readlink при каждом открытии модели.
+    
+    Returns:
+        "hardlink" или "symlink"
+    """
+    try:
+        same_fs = os.stat(src).st_dev == os.stat(dst.parent).st_dev
+    except OSError:
+        same_fs = False
+    if same_fs:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError as exc:
+            if exc.errno not in _HARDLINK_FALLBACK_ERRNOS:
+                raise
+    os.symlink(src, dst)
+    return "symlink"
+
+
+def _prepare_node_cache(
+    n_repo: str, n_commit: str, n_name: str, cache_path: pathlib.Path, offline: bool
+) -> bool:
+    """Склонировать (при необходимости) кеш кастом-ноды и перейти на commit. False — нода пропущена."""
+    fresh_clone = False
+    if not os.path.isdir(os.path.join(str(cache_path), ".git")):
+        if offline:
+            log_warn(
+                f"Offline режим: кэш для ноды {n_repo} не найден ({cache_path}), пропускаем"
+            )
+            return False
+        log_info(f"[resolver] клонирую кастом-ноду {n_repo} -> {cache_path}")
+        # Кеш ноды привязан к одному commit: при полном SHA качаем только его (depth=1)
+        if not (_is_full_sha(n_commit) and _shallow_fetch_commit(n_repo, n_commit, cache_path, init=True)):
+            # Partial clone: история без blob'ов, содержимое докачивается только для нужного commit
+            clone_cmd = ["git", "clone", "--filter=blob:none"]
+            if n_commit:
+                clone_cmd.append("--no-checkout")
+            code, out, err = run_command_tail(clone_cmd + [n_repo, str(cache_path)])
+            if code != 0:
+                log_warn(f"Failed to clone node {n_name}: {err or out}")
+                return False
+        fresh_clone = True
+    if n_commit:
+        # Кеш ноды привязан к commit: если он уже выписан — ни fetch, ни checkout не нужны
+        if not fresh_clone and _detached_head(cache_path) == n_commit:
+            log_info(f"[resolver] кастом-нода {n_name} уже на {n_commit[:12]}")
+            return True
+        # В сеть — только если commit ещё не скачан; сначала точечный shallow fetch, затем полный
+        if not offline and not fresh_clone and not _commit_in_cache(cache_path, n_commit):
+            if not (_is_full_sha(n_commit) and _shallow_fetch_commit(n_repo, n_commit, cache_path, init=False)):
+                run_command(["git", "-C", str(cache_path), "fetch", "--all", "--tags", "-q"])  # best-effort
+        run_command(["git", "-C", str(cache_path), "checkout", n_commit])
+    log_info(f"[resolver] кастом-нода {n_name} готова")
+    return True
+
+
+_FULL_SHA_RE = re.compile(r"[0-9a-f]{40}")
+
+
+def _is_full_sha(ref: str) -> bool:
+    return bool(_FULL_SHA_RE.fullmatch(ref))
+
+
+def _shallow_fetch_commit(
+    repo: str, commit: str, cache_path: pathlib.Path, *, init: bool, pin: bool = False
+) -> bool:
+    """git fetch --depth=1 одного commit (init=True — в новый репозиторий). False — сервер не отдал commit.
+
+    pin=True сохраняет commit веткой pinned/<sha>: без ссылки его не увидят клоны этого кеша.
+    """
+    target = str(cache_path)
+    steps: List[List[str]] = []
+    if init:
+        steps.append(["git", "init", "-q", target])
+        steps.append(["git", "-C", target, "remote", "add", "origin", repo])
+    refspec = f"{commit}:refs/heads/pinned/{commit}" if pin else commit
+    steps.append(["git", "-C", target, "fetch", "--depth=1", "-q", "origin", refspec])
+    for cmd in steps:
+        code, _, err = run_command_tail(cmd)
+        if code != 0:
+            log_info(f"[resolver] shallow fetch {commit[:12]} из {repo} не удался ({err}); полный fetch")
+            if init:
+                # Пустой каталог подходит для последующего git clone
+                shutil.rmtree(os.path.join(target, ".git"), ignore_errors=True)
+            return False
+    return True
 
-    custom_nodes_dir = comfy_home / "custom_nodes"
+
+def _detached_head(repo_path: pathlib.Path) -> Optional[str]:
+    """SHA из .git/HEAD, если HEAD отсоединён (после checkout <commit>); иначе None. Без запуска git."""
     try:
-        entries = sorted(custom_nodes_dir.iterdir())
+        with open(os.path.join(str(repo_path), ".git", "HEAD"), "r", encoding="ascii") as fh:
+            head = fh.read().strip()
+    except (OSError, UnicodeDecodeError):
+        return None
+    return None if head.startswith("ref:") else head
+
+
+def _node_requirement_files(comfy_home: pathlib.Path) -> List[Tuple[str, str]]:
+    """(имя ноды, requirements.txt) для каталогов custom_nodes, отсортировано по имени.
+
+    os.scandir отдаёт тип записи из readdir; ноды — симлинки в кеш, поэтому is_dir() следует по ним.
+    """
+    custom_nodes_dir = os.path.join(str(comfy_home), "custom_nodes")
+    result: List[Tuple[str, str]] = []
+    try:
+        with os.scandir(custom_nodes_dir) as it:
+            entries = sorted((entry for entry in it if _entry_is_dir(entry)), key=lambda entry: entry.name)
     except FileNotFoundError:
-        return
+        return result
     except OSError as exc:
         log_warn(f"Не удалось прочитать custom_nodes: {exc}")
-        return
+        return result
 
-    processed: Set[pathlib.Path] = set()
-
-    for node_dir in entries:
+    for entry in entries:
+        req_path = os.path.join(entry.path, "requirements.txt")
         try:
-            if not node_dir.is_dir():
+            if not stat.S_ISREG(os.stat(req_path).st_mode):
                 continue
         except OSError:
             continue
+        result.append((entry.name, req_path))
+    return result
 
-        requirements_path = node_dir / "requirements.txt"
 
-        if not requirements_path.exists():
-            continue
+def _entry_is_dir(entry: "os.DirEntry[str]") -> bool:
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
 
-        try:
-            install_key = requirements_path.resolve()
-        except OSError:
-            install_key = requirements_path
 
+def _install_custom_node_dependencies(
+    *,
+    python_exe: str,
+    comfy_home: pathlib.Path,
+    wheels_dir: Optional[pathlib.Path],
+    offline: bool,
+    node_files: Optional[List[Tuple[str, str]]] = None,
+    python_packages: Optional[List[str]] = None,
+) -> bool:
+    """
+    Установить зависимости кастом-нод одним вызовом pip.
+    
+    python_packages (пакеты из спецификации) добавляются в тот же вызов — резолвер pip
+    проходит объединённый набор один раз.
+    
+    Returns:
+        True, если python_packages установлены этим вызовом (иначе их ставит вызывающий)
+    """
+    if offline:
+        return False
+
+    if node_files is None:
+        node_files = _node_requirement_files(comfy_home)
+
+    processed: Set[str] = set()
+    requirement_files: List[Tuple[str, str]] = []
+
+    for node_name, requirements_path in node_files:
+        install_key = os.path.realpath(requirements_path)
         if install_key in processed:
             continue
         processed.add(install_key)
-
-        cmd = [python_exe, "-m", "pip", "install", "-r", str(requirements_path)]
-        if wheels_dir:
-            cmd.extend(["--no-index", "--find-links", str(wheels_dir)])
-
-        code, out, err = run_command(cmd)
+        requirement_files.append((node_name, requirements_path))
+
+    if not requirement_files:
+        return False
+
+    extra_args: List[str] = []
+    if wheels_dir:
+        extra_args.extend(["--no-index", "--find-links", str(wheels_dir)])
+
+    # Один вызов pip на все ноды: старт интерпретера и резолвер оплачиваются один раз,
+    # а общие зависимости дедуплицируются
+    cmd = [python_exe, "-m", "pip", "install"]
+    for _, requirements_path in requirement_files:
+        cmd.extend(["-r", requirements_path])
+    if python_packages:
+        cmd.extend(python_packages)
+    code, out, err = run_command(cmd + extra_args)
+    if code == 0:
+        return bool(python_packages)
+    # Повтор по нодам нужен, если общий вызов включал что-то кроме одной ноды;
+    # пакеты спецификации затем поставит вызывающий отдельно, после нод — как раньше
+    rerun = len(requirement_files) > 1 or bool(python_packages)
+    if rerun:
+        log_warn(f"Общий pip install для custom-нод завершился с кодом {code}; ставлю по нодам")
+
+    # Фолбэк по нодам — чтобы ошибка была привязана к конкретной ноде
+    for node_name, requirements_path in requirement_files:
+        if rerun:
+            code, out, err = run_command(
+                [python_exe, "-m", "pip", "install", "-r", requirements_path] + extra_args
+            )
         if code != 0:
-            node_name = node_dir.name
             log_warn(
                 f"pip install для custom-ноды {node_name} завершился с кодом {code}: {err or out}"
             )
+    return False
 
 
-def _parse_requirement_name(raw_line: str) -> Optional[str]:
-    line = raw_line.split("#", 1)[0].strip()
-    if not line or line.startswith(("-", "#")):
-        return None
-
-    if line.startswith(("http://", "https://", "git+", "file:", "svn+", "hg+", "bzr+", "ssh:")):
-        return None
-
-    if ";" in line:
-        line = line.split(";", 1)[0].strip()
-
-    for separator in ("==", "~=", ">=", "<=", "!=", ">", "<", "="):
-        if separator in line:
-            line = line.split(separator, 1)[0].strip()
-            break
+# Имя проекта в начале строки requirements.txt. Строки-опции (-r/-e/--...), комментарии,
+# URL/VCS (git+https://, file:, ./path) не совпадают: после имени обязан идти конец строки,
+# пробел, extras, маркер или оператор версии
+_REQ_NAME_RE = re.compile(
+    rb"^[ \t]*([A-Za-z0-9][A-Za-z0-9._-]*)(?=[ \t]*(?:[\[(;=<>!~@#]|\r?$))",
+    re.MULTILINE,
+)
 
-    if "[" in line:
-        line = line.split("[", 1)[0].strip()
 
-    normalized = line.replace("-", "_")
-    if normalized:
-        return normalized
-    return None
+def _scan_custom_nodes(
+    comfy_home: pathlib.Path,
+) -> Tuple[Dict[str, List[str]], List[Tuple[str, str]]]:
+    """Один обход custom_nodes: имена зависимостей по нодам и файлы requirements.txt для установки."""
+    node_files = _node_requirement_files(comfy_home)
+    return _collect_custom_node_requirements(comfy_home, node_files), node_files
 
 
-def _collect_custom_node_requirements(comfy_home: pathlib.Path) -> Dict[str, List[str]]:
+def _collect_custom_node_requirements(
+    comfy_home: pathlib.Path,
+    node_files: Optional[List[Tuple[str, str]]] = None,
+) -> Dict[str, List[str]]:
     requirements: Dict[str, List[str]] = {}
-    custom_nodes_dir = comfy_home / "custom_nodes"
 
-    try:
-        entries = sorted(custom_nodes_dir.iterdir())
-    except FileNotFoundError:
-        return requirements
-    except OSError as exc:
-        log_warn(f"Не удалось прочитать custom_nodes: {exc}")
-        return requirements
-
-    for node_dir in entries:
-        try:
-            if not node_dir.is_dir():
-                continue
-        except OSError:
-            continue
-
-        req_file = node_dir / "requirements.txt"
-        if not req_file.exists():
-            continue
+    if node_files is None:
+        node_files = _node_requirement_files(comfy_home)
 
+    for node_name, req_file in node_files:
         try:
-            lines = req_file.read_text(encoding="utf-8").splitlines()
+            with open(req_file, "rb") as fh:
+                content = fh.read()
         except OSError as exc:
             log_warn(f"Не удалось прочитать {req_file}: {exc}")
             continue
 
-        parsed: List[str] = []
-        for raw in lines:
-            name = _parse_requirement_name(raw)
-            if name:
-                parsed.append(name)
-
+        parsed = _requirement_names(content)
         if parsed:
-            requirements[node_dir.name] = parsed
+            requirements[node_name] = parsed
 
     return requirements
 
 
+def _requirement_names(content: bytes) -> List[str]:
+    # Один проход скомпилированного regex по всему файлу вместо split по строкам
+    return [match.group(1).decode("ascii").replace("-", "_") for match in _REQ_NAME_RE.finditer(content)]
+
+
+# Один обход sys.path через metadata.distributions() вместо поиска каждого пакета отдельно
+_DIST_PROBE_SCRIPT = (
+    "import json, re, sys\n"
+    "from importlib import metadata\n"
+    "canon = lambda name: re.sub(r'[-_.]+', '-', name).lower()\n"
+    "packages = json.loads(sys.argv[1])\n"
+    "installed = {canon(d.metadata['Name']) for d in metadata.distributions() if d.metadata['Name']}\n"
+    "print(json.dumps([pkg for pkg in packages if canon(pkg) not in installed]))\n"
+)
+
+
+def _probe_missing_distributions(python_exe: str, packages: List[str]) -> Tuple[Optional[List[str]], str]:
+    """Какие дистрибутивы не установлены в python_exe. (None, ошибка) — если проверить не удалось."""
+    if _is_current_interpreter(python_exe):
+        # Тот же интерпретатор — проверяем в процессе, без запуска python
+        import importlib
+
+        importlib.invalidate_caches()  # pip мог только что поставить пакеты
+        installed = _installed_distributions()
+        return [pkg for pkg in packages if _canonical_dist_name(pkg) not in installed], ""
+
+    code, out, err = run_command([python_exe, "-c", _DIST_PROBE_SCRIPT, json.dumps(packages)])
+    if code != 0:
+        return None, err or out
+    try:
+        return [str(item) for item in json.loads(out.strip() or "[]")], ""
+    except json.JSONDecodeError as exc:
+        return None, f"ошибка парсинга результата: {exc}; вывод={out}"
+
+
 def _verify_custom_node_requirements(
     *,
     python_exe: Optional[str],
     comfy_home: pathlib.Path,
     verbose: bool,
+    mapping: Optional[Dict[str, List[str]]] = None,
 ) -> None:
     if not python_exe:
         python_exe = _select_python_executable()
 
-    mapping = _collect_custom_node_requirements(comfy_home)
+    if mapping is None:
+        mapping = _collect_custom_node_requirements(comfy_home)
     if not mapping:
         if verbose:
             log_info("[resolver] requirements.txt для кастом-нод не найдены — проверка пропущена")
@@ -517,28 +999,9 @@ def _verify_custom_node_requirements(
 
     unique_packages = sorted({name for name in all_packages})
 
-    script = (
-        "import json, sys\n"
-        "from importlib import metadata\n"
-        "packages = json.loads(sys.argv[1])\n"
-        "missing = []\n"
-        "for pkg in packages:\n"
-        "    try:\n"
-        "        metadata.distribution(pkg)\n"
-        "    except metadata.PackageNotFoundError:\n"
-        "        missing.append(pkg)\n"
-        "print(json.dumps(missing))\n"
-    )
-
-    code, out, err = run_command([python_exe, "-c", script, json.dumps(unique_packages)])
-    if code != 0:
-        log_warn(f"Не удалось проверить зависимости кастом-нод (python={python_exe}): {err or out}")
-        return
-
-    try:
-        missing_list = json.loads(out.strip() or "[]")
-    except json.JSONDecodeError as exc:
-        log_warn(f"Ошибка парсинга результатов проверки зависимостей: {exc}; вывод={out}")
+    missing_list, probe_error = _probe_missing_distributions(python_exe, unique_packages)
+    if missing_list is None:
+        log_warn(f"Не удалось проверить зависимости кастом-нод (python={python_exe}): {probe_error}")
         return
 
     missing_set = {str(item) for item in missing_list if item}
@@ -567,18 +1030,9 @@ def _verify_custom_node_requirements(
         log_warn(f"pip install недостающих зависимостей завершился с кодом {code}: {err or out}")
     
     # Повторная проверка после попытки установки
-    code, out, err = run_command([python_exe, "-c", script, json.dumps(unique_packages)])
-    if code != 0:
-        log_warn(f"Не удалось повторно проверить зависимости после установки: {err or out}")
-        raise RuntimeError(
-            "Не установлены Python-зависимости для кастом-нод: "
-            + ", ".join(sorted(missing_set))
-        )
-    
-    try:
-        still_missing = json.loads(out.strip() or "[]")
-    except json.JSONDecodeError as exc:
-        log_warn(f"Ошибка парсинга результатов повторной проверки: {exc}; вывод={out}")
+    still_missing, probe_error = _probe_missing_distributions(python_exe, unique_packages)
+    if still_missing is None:
+        log_warn(f"Не удалось повторно проверить зависимости после установки: {probe_error}")
         raise RuntimeError(
             "Не установлены Python-зависимости для кастом-нод: "
             + ", ".join(sorted(missing_set))
@@ -640,13 +1094,21 @@ def resolve_version_spec(spec_path: pathlib.Path, offline: bool = False) -> Dict
     repo = comfy_in["repo"]
     ref = comfy_in.get("ref")
     commit = comfy_in.get("commit")
+
+    # Все недостающие commit (ComfyUI + кастом-ноды) резолвим одним параллельным проходом
+    remote_commits: Dict[Tuple[str, Optional[str]], Optional[str]] = {}
+    if not effective_offline:
+        pending = [(repo, ref)] if not commit else []
+        pending.extend((n["repo"], n.get("ref")) for n in spec.get("custom_nodes", []) if not n.get("commit"))
+        remote_commits = _git_ls_remote_many(pending)
+
     if not commit:
         if effective_offline:
             log_warn(
                 "Offline режим: commit для ComfyUI не указан в спецификации — используем текущее состояние"
             )
         else:
-            commit = _git_ls_remote(repo, ref)
+            commit = remote_commits.get((repo, ref))
             if not commit:
                 raise RuntimeError(
                     f"Не удалось резолвить commit для ComfyUI ({repo} {ref or 'HEAD'})"
@@ -666,7 +1128,7 @@ def resolve_version_spec(spec_path: pathlib.Path, offline: bool = False) -> Dict
                     f"Offline режим: commit не указан для кастом-ноды {n_repo} — пропускаем резолвинг"
                 )
             else:
-                n_commit = _git_ls_remote(n_repo, n_ref)
+                n_commit = remote_commits.get((n_repo, n_ref))
                 if not n_commit:
                     raise RuntimeError(
                         f"Не удалось резолвить commit для кастом-ноды ({n_repo} {n_ref or 'HEAD'})"
@@ -730,10 +1192,17 @@ def realize_from_resolved(
     log_info(f"[resolver] пути: COMFY_HOME={comfy_home}, MODELS_DIR={models_dir}")
  
     ready_python = _venv_python_path(comfy_home / ".venv")
-    has_python = ready_python.exists() and os.access(str(ready_python), os.X_OK)
+    has_python = _is_executable(ready_python)
     has_comfy_checkout = (comfy_home / "main.py").exists()
+    ready_build = has_python and has_comfy_checkout
+
+    signature = _signature_from_resolved(resolved)
+    marker = _load_prepared_marker(comfy_home)
+    stale = _stale_signature_sections(marker, signature)
 
-    if has_python and has_comfy_checkout:
+    # Build без маркера (например, собранный образ) считаем готовым, как и раньше;
+    # с маркером — сверяем разделы и доготавливаем только изменившиеся
+    if ready_build and (marker is None or not stale):
         log_info("[resolver] обнаружен готовый build, пропускаю подготовку и установки")
         os.environ["COMFY_HOME"] = str(comfy_home)
         os.environ["MODELS_DIR"] = str(models_dir)
@@ -758,40 +1227,40 @@ def realize_from_resolved(
 
     locked_interpreter = _select_python_from_lock(lock)
 
-    signature = _signature_from_resolved(resolved)
-    marker = _load_prepared_marker(comfy_home)
-
-    venv_python_path = _venv_python_path(comfy_home / ".venv")
-    locked_interpreter_path = pathlib.Path(locked_interpreter) if locked_interpreter else None
-
-    should_prepare = marker != signature
-    if not should_prepare and not locked_interpreter_path:
-        if not venv_python_path.exists():
+    if ready_build:
+        log_info(f"[resolver] изменились разделы спецификации: {', '.join(sorted(stale))}; остальные не трогаю")
+    else:
+        # Без venv или checkout частичная подготовка невозможна: новый venv пуст — готовим все разделы
+        if marker is not None:
             log_warn(
-                f"[resolver] маркер найден, но виртуальное окружение отсутствует ({venv_python_path}); переинициализирую"
+                f"[resolver] маркер найден, но venv или checkout ComfyUI отсутствует ({comfy_home}); переинициализирую"
             )
-            should_prepare = True
-            marker = None
+        stale = set(_SIGNATURE_SECTIONS)
 
-    if not should_prepare:
-        log_info("[resolver] найден маркер подготовленного окружения, пропускаю повторную установку")
+    # Секции готовятся независимо: неизменившиеся пропускаются целиком
+    prepare_comfy = "comfy_sig" in stale
+    prepare_nodes = "custom_nodes_sig" in stale
+    # pip ComfyUI/нод может сдвинуть версии пакетов спецификации — тогда ставим их заново
+    prepare_packages = prepare_comfy or prepare_nodes or "python_packages_sig" in stale
+    prepare_models = "models_sig" in stale
 
-    if should_prepare:
+    if prepare_comfy:
         log_info(f"[resolver] готовлю ComfyUI из {repo} (commit={commit})")
-        cache_repo = _ensure_repo_cache(repo, offline=offline)
+        cache_repo = _ensure_repo_cache(repo, offline=offline, commit=commit)
         try:
             _checkout_from_cache(
                 cache_repo=cache_repo,
                 target_repo=repo_dir,
                 commit=commit,
                 offline=offline,
+                keep=(comfy_home / ".venv", models_dir),
             )
         except RuntimeError as exc:
             raise RuntimeError(f"Не удалось подготовить ComfyUI в {repo_dir}: {exc}")
 
     # Проверяем venv в текущем comfy_home (целевая директория развёртки)
     venv_in_target = _venv_python_path(comfy_home / ".venv")
-    if venv_in_target.exists() and os.access(str(venv_in_target), os.X_OK):
+    if _is_executable(venv_in_target):
         python_path = str(venv_in_target)
     else:
         # Создаём venv в comfy_home
@@ -800,27 +1269,27 @@ def realize_from_resolved(
 
     # Ensure custom_nodes directory exists in checkout (may be absent in repo for fresh clone)
     (repo_dir / "custom_nodes").mkdir(parents=True, exist_ok=True)
-    if should_prepare:
-        log_info(f"[resolver] директория custom_nodes готова")
+    log_info(f"[resolver] директория custom_nodes готова")
 
     log_info(f"[resolver] выбран интерпретатор Python: {python_path}")
     req = repo_dir / "requirements.txt"
-    if should_prepare and req.exists() and not offline:
+    comfy_req_future: Optional["Future[Tuple[int, str, str]]"] = None
+    if prepare_comfy and req.exists() and not offline:
         log_info(f"[resolver] устанавливаю зависимости из {req}")
         cmd = [python_path, "-m", "pip", "install"]
         if wheels_dir:
             cmd.extend(["--no-index", "--find-links", str(wheels_dir)])
         cmd.extend(["-r", str(req)])
-        code, out, err = run_command(cmd)
-        if code != 0:
-            log_warn(f"pip install ComfyUI requirements failed: {err or out}")
-        else:
-            log_info("[resolver] зависимости ComfyUI установлены")
+        # pip ComfyUI идёт в фоне, параллельно с клонами нод; следующий pip в этот venv — только после него
+        pip_executor = ThreadPoolExecutor(max_workers=1)
+        comfy_req_future = pip_executor.submit(run_command, cmd)
+        pip_executor.shutdown(wait=False)
 
     # Custom nodes: clone to cache and symlink
     cache_root = _nodes_cache_root()
     cache_root.mkdir(parents=True, exist_ok=True)
     nodes = resolved.get("custom_nodes") or []
+    node_entries: List[Tuple[str, str, str, pathlib.Path]] = []
     if isinstance(nodes, list):
         for n in nodes:
             if not isinstance(n, dict):
@@ -831,52 +1300,71 @@ def realize_from_resolved(
             if not n_repo:
                 continue
             cache_name = f"{_slug_from_repo(n_repo)}@{n_commit or 'latest'}"
-            cache_path = cache_root / cache_name
-            if should_prepare:
-                if not (cache_path / ".git").exists():
-                    if offline:
-                        log_warn(
-                            f"Offline режим: кэш для ноды {n_repo} не найден ({cache_path}), пропускаем"
-                        )
-                        continue
-                    log_info(f"[resolver] клонирую кастом-ноду {n_repo} -> {cache_path}")
-                    code, out, err = run_command(["git", "clone", n_repo, str(cache_path)])
-                    if code != 0:
-                        log_warn(f"Failed to clone node {n_name}: {err or out}")
-                        continue
-                if n_commit:
-                    if not offline:
-                        run_command(["git", "-C", str(cache_path), "fetch", "--all", "--tags", "-q"])  # best-effort
-                    run_command(["git", "-C", str(cache_path), "checkout", n_commit])
-                log_info(f"[resolver] кастом-нода {n_name} готова")
-            dst = repo_dir / "custom_nodes" / n_name
-            _ensure_symlink(cache_path, dst)
-
-    if should_prepare:
-        _install_custom_node_dependencies(
+            node_entries.append((n_repo, n_commit, n_name, cache_root / cache_name))
+
+    ready_caches: Set[pathlib.Path] = set()
+    if prepare_nodes and node_entries:
+        # Клоны/fetch нод — сетевые и в разные каталоги: готовим кеши параллельно
+        # (один и тот же repo@commit — одной задачей), симлинки ставим уже последовательно
+        unique_entries = list({entry[3]: entry for entry in node_entries}.values())
+        workers = max(1, min(len(unique_entries), _GIT_WORKERS))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_prepare_node_cache, n_repo, n_commit, n_name, cache_path, offline): cache_path
+                for n_repo, n_commit, n_name, cache_path in unique_entries
+            }
+            for future in as_completed(futures):
+                if future.result():
+                    ready_caches.add(futures[future])
+
+    for n_repo, n_commit, n_name, cache_path in node_entries:
+        if prepare_nodes and cache_path not in ready_caches:
+            continue
+        dst = repo_dir / "custom_nodes" / n_name
+        _ensure_symlink(cache_path, dst)
+
+    # custom_nodes обходим один раз — результат нужен и установке, и проверке зависимостей
+    node_requirements, node_files = _scan_custom_nodes(comfy_home)
+
+    python_packages = resolved.get("python_packages")
+    if not isinstance(python_packages, list):
+        python_packages = []
+    packages_installed = False
+    # Два pip в одном venv одновременно ломают site-packages (общие транзитивные зависимости
+    # переустанавливаются параллельно) — дожидаемся pip ComfyUI до любой другой установки
+    if comfy_req_future is not None:
+        _finish_comfy_requirements(comfy_req_future)
+
+    if prepare_nodes:
+        # Пакеты спецификации — в тот же вызов pip, что и зависимости нод
+        packages_installed = _install_custom_node_dependencies(
             python_exe=python_path,
             comfy_home=comfy_home,
             wheels_dir=wheels_dir,
             offline=offline,
+            node_files=node_files,
+            python_packages=python_packages if prepare_packages else None,
         )
 
-        # Install python packages from spec
-        python_packages = resolved.get("python_packages")
-        if isinstance(python_packages, list) and python_packages:
-            if not offline:
-                log_info(f"[resolver] устанавливаю Python пакеты из спецификации: {', '.join(python_packages)}")
-                cmd = [python_path, "-m", "pip", "install"]
-                if wheels_dir:
-                    cmd.extend(["--no-index", "--find-links", str(wheels_dir)])
-                cmd.extend(python_packages)
-                code, out, err = run_command(cmd)
-                if code != 0:
-                    log_warn(f"pip install python_packages завершился с кодом {code}: {err or out}")
-                else:
-                    log_info("[resolver] Python пакеты из спецификации установлены")
+    # Install python packages from spec
+    if prepare_packages and python_packages:
+        if packages_installed:
+            log_info("[resolver] Python пакеты из спецификации установлены вместе с зависимостями нод")
+        elif not offline:
+            log_info(f"[resolver] устанавливаю Python пакеты из спецификации: {', '.join(python_packages)}")
+            cmd = [python_path, "-m", "pip", "install"]
+            if wheels_dir:
+                cmd.extend(["--no-index", "--find-links", str(wheels_dir)])
+            cmd.extend(python_packages)
+            code, out, err = run_command(cmd)
+            if code != 0:
+                log_warn(f"pip install python_packages завершился с кодом {code}: {err or out}")
             else:
-                log_warn(f"Offline режим: пропускаю установку python_packages ({len(python_packages)} пакетов)")
+                log_info("[resolver] Python пакеты из спецификации установлены")
+        else:
+            log_warn(f"Offline режим: пропускаю установку python_packages ({len(python_packages)} пакетов)")
 
+    if prepare_models:
         log_info("[resolver] подготовка моделей")
         _prepare_models(
             resolved_models=resolved.get("models") or [],
@@ -885,10 +1373,8 @@ def realize_from_resolved(
             offline=offline,
         )
 
-        _save_prepared_marker(comfy_home, signature)
-        log_info("[resolver] окружение ComfyUI подготовлено и промаркеровано")
-    else:
-        log_info("[resolver] пропускаю подготовку, окружение уже готово")
+    _save_prepared_marker(comfy_home, signature)
+    log_info("[resolver] окружение ComfyUI подготовлено и промаркеровано")
 
     # Export env
     os.environ["COMFY_HOME"] = str(comfy_home)
@@ -903,7 +1389,8 @@ def realize_from_resolved(
         _verify_custom_node_requirements(
             python_exe=python_path,
             comfy_home=comfy_home,
-            verbose=should_prepare,
+            verbose=True,
+            mapping=node_requirements,
         )
     except RuntimeError as exc:
         raise RuntimeError(str(exc))
@@ -912,6 +1399,85 @@ def realize_from_resolved(
     return comfy_home, models_dir
 
 
+def _finish_comfy_requirements(future: "Future[Tuple[int, str, str]]") -> None:
+    code, out, err = future.result()
+    if code != 0:
+        log_warn(f"pip install ComfyUI requirements failed: {err or out}")
+    else:
+        log_info("[resolver] зависимости ComfyUI установлены")
+
+
+# Кеш checksum моделей: realpath -> {algo, hex, size, mtime_ns}. Файл не изменился (stat совпал) —
+# многогигабайтный файл заново не хэшируем. На диск пишется при выходе из процесса
+_CHECKSUMS: Optional[Dict[str, Dict[str, object]]] = None
+_CHECKSUMS_DIRTY = False
+_CHECKSUMS_LOCK = threading.Lock()
+
+
+def _checksum_cache_path() -> pathlib.Path:
+    return cache_root() / "checksums.json"
+
+
+def _checksum_entries() -> Dict[str, Dict[str, object]]:
+    # Вызывается под _CHECKSUMS_LOCK
+    global _CHECKSUMS
+    if _CHECKSUMS is None:
+        try:
+            data = _json_loads(_checksum_cache_path().read_bytes())
+        except (OSError, ValueError):
+            data = {}
+        _CHECKSUMS = data if isinstance(data, dict) else {}
+    return _CHECKSUMS
+
+
+def _remember_checksum(path: pathlib.Path, algo: str, hex_digest: str, st: Optional[os.stat_result] = None) -> None:
+    global _CHECKSUMS_DIRTY
+    try:
+        st = st or os.stat(path)
+    except OSError:
+        return
+    entry = {"algo": algo, "hex": hex_digest, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    with _CHECKSUMS_LOCK:
+        _checksum_entries()[os.path.realpath(path)] = entry
+        if not _CHECKSUMS_DIRTY:
+            _CHECKSUMS_DIRTY = True
+            atexit.register(_save_checksums)
+
+
+def _cached_checksum(path: pathlib.Path, algo: str) -> str:
+    """hex checksum файла; повторно не считается, пока не изменились размер и mtime."""
+    st = os.stat(path)
+    with _CHECKSUMS_LOCK:
+        entry = _checksum_entries().get(os.path.realpath(path))
+    if (
+        entry
+        and entry.get("algo") == algo
+        and entry.get("size") == st.st_size
+        and entry.get("mtime_ns") == st.st_mtime_ns
+    ):
+        return str(entry.get("hex"))
+    hex_digest = verify_models.compute_checksum(str(path), algo=algo).split(":", 1)[1]
+    _remember_checksum(path, algo, hex_digest, st)
+    return hex_digest
+
+
+def _save_checksums() -> None:
+    global _CHECKSUMS_DIRTY
+    with _CHECKSUMS_LOCK:
+        if not _CHECKSUMS_DIRTY or _CHECKSUMS is None:
+            return
+        payload = json_dumps_pretty(_CHECKSUMS, sort_keys=True)
+        _CHECKSUMS_DIRTY = False
+    path = _checksum_cache_path()
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp.write_bytes(payload)
+        os.replace(tmp, path)
+    except OSError as exc:
+        log_warn(f"Не удалось сохранить кеш checksum {path}: {exc}")
+
+
 def _prepare_models(
     *,
     resolved_models: List[Dict[str, object]],
@@ -928,122 +1494,199 @@ def _prepare_models(
         "COMFY_HOME": str(comfy_home),
     }
 
-    for model in resolved_models:
-        if not isinstance(model, dict):
-            continue
+    models = [model for model in resolved_models if isinstance(model, dict)]
+    # Каталоги, уже созданные в этом прогоне: общий родитель многих моделей mkdir'ится один раз
+    made_dirs: Set[pathlib.Path] = set()
+    workers = max(1, min(len(models), _MODEL_WORKERS))
+    if workers == 1:
+        for model in models:
+            _prepare_one_model(
+                model, models_dir=models_dir, env_vars=env_vars, offline_effective=offline_effective, made_dirs=made_dirs
+            )
+        return
 
-        source = str(model.get("source") or "").strip()
-        target_path_raw = str(model.get("target_path") or "").strip()
-        checksum_raw = str(model.get("checksum") or "").strip() or None
-        name = str(model.get("name") or target_path_raw or "model").strip() or "model"
+    # Скачивание и хэширование — сетевой/дисковый I/O (GIL отпускается): модели готовим параллельно.
+    # mkdir(exist_ok=True) для общего родительского каталога безопасен и без блокировки,
+    # гонка по made_dirs приводит лишь к лишнему mkdir
+    first_error: Optional[BaseException] = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                _prepare_one_model,
+                model,
+                models_dir=models_dir,
+                env_vars=env_vars,
+                offline_effective=offline_effective,
+                made_dirs=made_dirs,
+            )
+            for model in models
+        ]
+        for future in as_completed(futures):
+            exc = future.exception()
+            if exc is not None and first_error is None:
+                first_error = exc
+    if first_error is not None:
+        raise first_error
+
+
+def _ensure_dir(path: pathlib.Path, made_dirs: Optional[Set[pathlib.Path]]) -> None:
+    """mkdir -p, пропуская каталоги, уже созданные в текущем прогоне."""
+    if made_dirs is not None and path in made_dirs:
+        return
+    path.mkdir(parents=True, exist_ok=True)
+    if made_dirs is not None:
+        made_dirs.add(path)
 
-        if not target_path_raw:
-            log_warn(f"models entry '{name}' пропущен: не указан target_path")
-            continue
 
-        target_expanded = expand_env(target_path_raw, extra_env=env_vars).strip()
-        if not target_expanded:
-            log_warn(f"models entry '{name}' пропущен: target_path пуст после развёртки")
-            continue
+def _prepare_one_model(
+    model: Dict[str, object],
+    *,
+    models_dir: pathlib.Path,
+    env_vars: Dict[str, str],
+    offline_effective: bool,
+    made_dirs: Optional[Set[pathlib.Path]] = None,
+) -> None:
+    source = str(model.get("source") or "").strip()
+    target_path_raw = str(model.get("target_path") or "").strip()
+    checksum_raw = str(model.get("checksum") or "").strip() or None
+    name = str(model.get("name") or target_path_raw or "model").strip() or "model"
 
-        target_path = pathlib.Path(target_expanded)
-        if target_path.is_absolute():
-            target_abs = target_path.resolve()
-        else:
-            target_abs = (models_dir / target_path).resolve()
-        target_abs.parent.mkdir(parents=True, exist_ok=True)
+    if not target_path_raw:
+        log_warn(f"models entry '{name}' пропущен: не указан target_path")
+        return
 
-        checksum_algo, checksum_hex = verify_models.parse_checksum(checksum_raw)
+    target_expanded = expand_env(target_path_raw, extra_env=env_vars).strip()
+    if not target_expanded:
+        log_warn(f"models entry '{name}' пропущен: target_path пуст после развёртки")
+        return
 
-        if not source:
-            if not target_abs.exists():
-                log_warn(f"Модель '{name}' не имеет source и отсутствует по пути {target_abs}")
-            elif checksum_hex and checksum_algo:
-                actual = verify_models.compute_checksum(str(target_abs), algo=checksum_algo).split(":", 1)[1]
-                if actual != checksum_hex:
-                    log_warn(
-                        f"Модель '{name}' имеет checksum mismatch и не имеет source для переустановки"
-                    )
-            continue
+    target_path = pathlib.Path(target_expanded)
+    if target_path.is_absolute():
+        target_abs = target_path.resolve()
+    else:
+        target_abs = (models_dir / target_path).resolve()
 
-        if not target_abs.exists():
-            existing_path = _find_existing_model(
-                models_dir=models_dir,
-                target_abs=target_abs,
-                checksum_algo=checksum_algo,
-                checksum_hex=checksum_hex,
-            )
-            if existing_path:
-                try:
-                    if existing_path.resolve() == target_abs:
-                        log_info(f"Модель '{name}' уже присутствует: {target_abs}")
-                        continue
-                except Exception:
-                    pass
+    checksum_algo, checksum_hex = verify_models.parse_checksum(checksum_raw)
 
-                try:
-                    log_info(
-                        f"Модель '{name}' найдена в кеше: {existing_path}, создаю симлинк -> {target_abs}"
-                    )
-                    target_abs.parent.mkdir(parents=True, exist_ok=True)
-                    if target_abs.is_symlink():
-                        target_abs.unlink()
-                    os.symlink(existing_path, target_abs)
-                    log_info(f"Модель '{name}' подключена симлинком из {existing_path}")
-                    continue
-                except OSError as exc:
-                    raise RuntimeError(
-                        f"Не удалось создать симлинк для модели '{name}' из {existing_path}: {exc}"
-                    )
-                except Exception as exc:
-                    log_warn(f"Не удалось создать симлинк для модели '{name}' из {existing_path}: {exc}")
+    # Один stat на модель: файл есть и checksum не задан — считаем валидным (самый частый случай)
+    try:
+        os.stat(target_abs)
+        target_exists = True
+    except OSError:
+        target_exists = False
+    if target_exists and not (checksum_hex and checksum_algo):
+        return
 
-        if target_abs.exists():
-            if checksum_hex and checksum_algo:
-                actual = verify_models.compute_checksum(str(target_abs), algo=checksum_algo).split(":", 1)[1]
-                if actual == checksum_hex:
-                    continue
-                if offline_effective:
-                    log_warn(
-                        f"Offline режим: checksum mismatch для '{name}' ({target_abs}), оставляю существующий файл"
-                    )
-                    continue
-            else:
-                # файл существует, checksum не задан — считаем валидным
-                continue
+    if not source:
+        if not target_exists:
+            log_warn(f"Модель '{name}' не имеет source и отсутствует по пути {target_abs}")
+        else:
+            actual = _cached_checksum(target_abs, checksum_algo)
+            if actual != checksum_hex:
+                log_warn(
+                    f"Модель '{name}' имеет checksum mismatch и не имеет source для переустановки"
+                )
+        return
 
+    if not target_exists:
+        existing_path = _find_existing_model(
+            models_dir=models_dir,
+            target_abs=target_abs,
+            checksum_algo=checksum_algo,
+            checksum_hex=checksum_hex,
+        )
+        if existing_path:
+            try:
+                if existing_path.resolve() == target_abs:
+                    log_info(f"Модель '{name}' уже присутствует: {target_abs}")
+                    return
+            except Exception:
+                pass
+
+            try:
+                log_info(
+                    f"Модель '{name}' найдена в кеше: {existing_path}, создаю ссылку -> {target_abs}"
+                )
+                _ensure_dir(target_abs.parent, made_dirs)
+                if target_abs.is_symlink():
+                    target_abs.unlink()
+                kind = _link_model(existing_path, target_abs)
+                log_info(f"Модель '{name}' подключена ({kind}) из {existing_path}")
+                return
+            except OSError as exc:
+                raise RuntimeError(
+                    f"Не удалось создать ссылку для модели '{name}' из {existing_path}: {exc}"
+                )
+            except Exception as exc:
+                log_warn(f"Не удалось создать ссылку для модели '{name}' из {existing_path}: {exc}")
+
+    if target_exists:
+        actual = _cached_checksum(target_abs, checksum_algo)
+        if actual == checksum_hex:
+            return
         if offline_effective:
             log_warn(
-                f"Offline режим: модель '{name}' отсутствует (или checksum mismatch) и недоступна для загрузки"
+                f"Offline режим: checksum mismatch для '{name}' ({target_abs}), оставляю существующий файл"
             )
-            continue
+            return
 
-        if not source:
-            log_warn(f"Модель '{name}' отсутствует по пути {target_abs} и не имеет source для загрузки")
-            continue
+    if offline_effective:
+        log_warn(
+            f"Offline режим: модель '{name}' отсутствует (или checksum mismatch) и недоступна для загрузки"
+        )
+        return
 
-        try:
-            # Создаем временную директорию в той же папке, где будет файл
-            target_dir = target_abs.parent
-            target_dir.mkdir(parents=True, exist_ok=True)
-            
-            with tempfile.TemporaryDirectory(prefix=".model_fetch_", dir=str(target_dir)) as tmp_dir:
-                log_info(f"Загрузка модели '{name}' из source: {source}")
-                # Скачиваем во временную директорию в той же файловой системе
+    if not source:
+        log_warn(f"Модель '{name}' отсутствует по пути {target_abs} и не имеет source для загрузки")
+        return
+
+    try:
+        # Создаем временную директорию в той же папке, где будет файл
+        target_dir = target_abs.parent
+        _ensure_dir(target_dir, made_dirs)
+        
+        with tempfile.TemporaryDirectory(prefix=".model_fetch_", dir=str(target_dir)) as tmp_dir:
+            log_info(f"Загрузка модели '{name}' из source: {source}")
+            # Скачиваем во временную директорию в той же файловой системе
+            if checksum_hex and checksum_algo:
+                # Хэш считается во время загрузки — без повторного чтения файла
+                tmp_path, actual = verify_models.fetch_to_temp_with_hash(
+                    source, tmp_dir=tmp_dir, algo=checksum_algo, timeout=_MODEL_FETCH_TIMEOUT
+                )
+                if actual != checksum_hex:
+                    raise RuntimeError("downloaded checksum mismatch")
+            else:
                 tmp_path = verify_models.fetch_to_temp(source, tmp_dir=tmp_dir, timeout=_MODEL_FETCH_TIMEOUT)
-                
-                if checksum_hex and checksum_algo:
-                    actual = verify_models.compute_checksum(tmp_path, algo=checksum_algo).split(":", 1)[1]
-                    if actual != checksum_hex:
-                        raise RuntimeError("downloaded checksum mismatch")
-                
-                # Атомарное переименование без копирования (обе папки на одной ФС)
-                os.replace(tmp_path, str(target_abs))
-                log_info(f"Модель '{name}' сохранена: {target_abs}")
-        except Exception as exc:
-            raise RuntimeError(
-                f"Не удалось загрузить модель '{name}' (source={source}, target={target_abs}): {exc}"
-            ) from exc
+            
+            # Атомарное переименование без копирования (обе папки на одной ФС)
+            os.replace(tmp_path, str(target_abs))
+            if checksum_hex and checksum_algo:
+                _remember_checksum(target_abs, checksum_algo, actual)
+            log_info(f"Модель '{name}' сохранена: {target_abs}")
+    except Exception as exc:
+        raise RuntimeError(
+            f"Не удалось загрузить модель '{name}' (source={source}, target={target_abs}): {exc}"
+        ) from exc
+
+
+# Стандартные подкаталоги моделей ComfyUI
+_DEFAULT_MODEL_SUBDIRS = (
+    "audio_encoders",
+    "checkpoints",
+    "clip",
+    "clip_vision",
+    "configs",
+    "controlnet",
+    "diffusion_models",
+    "embeddings",
+    "inpaint",
+    "loras",
+    "photomaker",
+    "text_encoders",
+    "unet",
+    "upscale_models",
+    "vae",
+)
 
 
 def _write_extra_model_paths(
@@ -1057,27 +1700,12 @@ def _write_extra_model_paths(
         "base_path": str(models_dir),
     }
 
-    default_subdirs = [
-        "audio_encoders",
-        "checkpoints",
-        "clip",
-        "clip_vision",
-        "configs",
-        "controlnet",
-        "diffusion_models",
-        "embeddings",
-        "inpaint",
-        "loras",
-        "photomaker",
-        "text_encoders",
-        "unet",
-        "upscale_models",
-        "vae",
-    ]
-
-    for subdir in default_subdirs:
+    for subdir in _DEFAULT_MODEL_SUBDIRS:
         mapping[subdir] = str(models_dir / subdir)
 
+    # Сначала уникальные каталоги-родители моделей (кортежи частей пути), затем все их префиксы —
+    # каждый ключ строится один раз, без pathlib во внутреннем цикле
+    parent_parts: Set[Tuple[str, ...]] = set()
     if resolved_models:
         for model in resolved_models:
             if not isinstance(model, dict):
@@ -1098,19 +1726,27 @@ def _write_extra_model_paths(
             if relative_root is None:
                 continue
 
-            parts = list(relative_root.parts)
-            current = pathlib.Path()
-            for part in parts[:-1]:
-                current = current / part
-                key = str(current)
-                if key:
-                    mapping.setdefault(key, str(models_dir / current))
+            parents = relative_root.parts[:-1]
+            if parents:
+                parent_parts.add(parents)
+
+    base_path = str(models_dir)
+    prefixes = {parts[:depth] for parts in parent_parts for depth in range(1, len(parts) + 1)}
+    for prefix in prefixes:
+        key = os.path.join(*prefix)
+        mapping.setdefault(key, os.path.join(base_path, key))
 
     try:
-        lines = ["comfyui:\n"]
-        for key in sorted(mapping.keys()):
-            lines.append(f"  {key}: {mapping[key]}\n")
-        extra_yaml.write_text("".join(lines), encoding="utf-8")
+        payload = bytearray(b"comfyui:\n")
+        for key in sorted(mapping):
+            payload += f"  {key}: {mapping[key]}\n".encode("utf-8")
+        # Содержимое не изменилось — файл не переписываем (mtime остаётся прежним)
+        try:
+            if extra_yaml.stat().st_size == len(payload) and extra_yaml.read_bytes() == payload:
+                return
+        except OSError:
+            pass
+        extra_yaml.write_bytes(payload)
     except Exception as exc:
         log_warn(f"Не удалось записать extra_model_paths.yaml: {exc}")
 
@@ -1157,17 +1793,9 @@ def validate_version_spec(raw_spec: object, source_path: pathlib.Path) -> Dict[s
             raise SpecValidationError(
                 f"{source_path}: custom_nodes[{idx}].repo обязателен и должен быть строкой"
             )
-        node_ref = _optional_trimmed_str(entry.get("ref"), source_path, f"custom_nodes[{idx}].ref")
-        node_commit = _optional_trimmed_str(entry.get("commit"), source_path, f"custom_nodes[{idx}].commit")
-        node_name = _optional_trimmed_str(entry.get("name"), source_path, f"custom_nodes[{idx}].name")
-        custom_nodes.append(
-            {
-                "repo": repo_value.strip(),
-                "ref": node_ref,
-                "commit": node_commit,
-                "name": node_name,
-            }
-        )
+        node_entry: Dict[str, Optional[str]] = {"repo": repo_value.strip()}
+        _collect_trimmed_fields(entry, _NODE_OPTIONAL_FIELDS, node_entry, source_path, "custom_nodes", idx)
+        custom_nodes.append(node_entry)
 
     models_raw = raw_spec.get("models", [])
     if models_raw is None:
@@ -1185,24 +1813,11 @@ def validate_version_spec(raw_spec: object, source_path: pathlib.Path) -> Dict[s
             raise SpecValidationError(
                 f"{source_path}: models[{idx}].source обязателен и должен быть строкой"
             )
-        name_value = _optional_trimmed_str(entry.get("name"), source_path, f"models[{idx}].name")
-        target_subdir_value = _optional_trimmed_str(
-            entry.get("target_subdir"), source_path, f"models[{idx}].target_subdir"
-        )
-        target_path_value = _optional_trimmed_str(
-            entry.get("target_path"), source_path, f"models[{idx}].target_path"
-        )
-        path_value = _optional_trimmed_str(entry.get("path"), source_path, f"models[{idx}].path")
-
-        model_entry: Dict[str, Optional[str]] = {
-            "source": source_value.strip(),
-            "name": name_value,
-            "target_subdir": target_subdir_value,
-            "target_path": target_path_value,
-        }
-
-        if path_value is not None:
-            model_entry["path"] = path_value
+        model_entry: Dict[str, Optional[str]] = {"source": source_value.strip()}
+        _collect_trimmed_fields(entry, _MODEL_OPTIONAL_FIELDS, model_entry, source_path, "models", idx)
+        # path — только если задан
+        if model_entry["path"] is None:
+            del model_entry["path"]
 
         models.append(model_entry)
 
@@ -1278,8 +1893,44 @@ def _optional_trimmed_str(value: object, source_path: pathlib.Path, field_name:
     return trimmed or None
 
 
+# Необязательные строковые поля элементов custom_nodes/models (в порядке вывода)
+_NODE_OPTIONAL_FIELDS = ("ref", "commit", "name")
+_MODEL_OPTIONAL_FIELDS = ("name", "target_subdir", "target_path", "path")
+
+
+def _collect_trimmed_fields(
+    entry: Dict[str, object],
+    fields: Tuple[str, ...],
+    out: Dict[str, Optional[str]],
+    source_path: pathlib.Path,
+    section: str,
+    idx: int,
+) -> None:
+    """Как _optional_trimmed_str для нескольких полей; имя поля форматируется только при ошибке."""
+    for field in fields:
+        value = entry.get(field)
+        if value is None:
+            out[field] = None
+        elif isinstance(value, str):
+            out[field] = value.strip() or None
+        else:
+            raise SpecValidationError(f"{source_path}: поле '{section}[{idx}].{field}' должно быть строкой")
+
+
 # ---------------------------- helpers: interpreter ---------------------------- #
 
+def _is_executable(path: pathlib.Path) -> bool:
+    """Исполняемый файл? Один stat вместо пары exists() + os.access(X_OK)."""
+    if os.name == "nt":
+        return path.is_file()
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return stat.S_ISREG(st.st_mode) and bool(st.st_mode & 0o111)
+
+
+@lru_cache(maxsize=16)
 def _venv_python_path(venv_dir: pathlib.Path) -> pathlib.Path:
     """Возвращает путь к python внутри venv для текущей платформы."""
     if os.name == "nt":
@@ -1294,6 +1945,11 @@ def _ensure_comfy_venv(
 ) -> Optional[str]:
     """Гарантирует наличие venv внутри COMFY_HOME и возвращает путь к python."""
 
+    # Готовый venv — без mkdir и проверки прав на каталог
+    ready = _check_venv(str(comfy_home))
+    if ready:
+        return ready
+
     try:
         comfy_home.mkdir(parents=True, exist_ok=True)
     except Exception as exc:
@@ -1308,9 +1964,6 @@ def _ensure_comfy_venv(
     venv_dir = comfy_home / ".venv"
     python_path = _venv_python_path(venv_dir)
 
-    if python_path.exists() and os.access(str(python_path), os.X_OK):
-        return str(python_path)
-
     base_python = _select_python_executable()
     venv_mode = os.environ.get("COMFY_VENV_MODE", "copies").strip().lower()
 
@@ -1342,16 +1995,26 @@ def _ensure_comfy_venv(
     return str(python_path)
 
 
+# COMFY_HOME -> python найденного venv. Запоминаются только найденные: venv может появиться позже
+_VENV_PYTHONS: Dict[str, str] = {}
+
+
+def _check_venv(comfy_home: str) -> Optional[str]:
+    """Путь к python готового venv в COMFY_HOME (один stat, затем из памяти) или None."""
+    cached = _VENV_PYTHONS.get(comfy_home)
+    if cached:
+        return cached
+    py = _venv_python_path(pathlib.Path(comfy_home) / ".venv")
+    if not _is_executable(py):
+        return None
+    _VENV_PYTHONS[comfy_home] = str(py)
+    return str(py)
+
+
 def _venv_python_from_env() -> Optional[str]:
     """Если задан COMFY_HOME и существует venv, вернуть путь к его python."""
     comfy_home = os.environ.get("COMFY_HOME")
-    if not comfy_home:
-        return None
-    venv_dir = pathlib.Path(comfy_home) / ".venv"
-    py = _venv_python_path(venv_dir)
-    if py.exists() and os.access(str(py), os.X_OK):
-        return str(py)
-    return None
+    return _check_venv(comfy_home) if comfy_home else None
 
 
 def _resolve_python_interpreter(lock: Dict[str, object], verbose: bool = False) -> str:
@@ -1367,7 +2030,7 @@ def _resolve_python_interpreter(lock: Dict[str, object], verbose: bool = False)
             interp = python.get("interpreter")
             if isinstance(interp, str) and interp:
                 p = pathlib.Path(interp)
-                if p.exists() and os.access(str(p), os.X_OK):
+                if _is_executable(p):
                     if verbose:
                         log_info(f"Using Python interpreter from lock: {interp}")
                     return str(p)
@@ -1396,7 +2059,7 @@ def _select_python_from_lock(lock: Dict[str, object]) -> Optional[str]:
     if not isinstance(interpreter, str) or not interpreter:
         return None
     path = pathlib.Path(interpreter)
-    if path.exists() and os.access(str(path), os.X_OK):
+    if _is_executable(path):
         return str(path)
     return None
 
@@ -1420,37 +2083,44 @@ def _find_existing_model(
         pathlib.Path("/workspace/models"),
         pathlib.Path("/runpod-volume/models"),
     ]
+    # Дедупликация по реальному пути: /workspace и /runpod-volume часто указывают на один volume
+    seen_dirs = {os.path.realpath(models_dir)}
     for std_path in standard_paths:
-        if std_path.exists() and std_path.resolve() != models_dir.resolve():
+        if not std_path.exists():
+            continue
+        real_path = os.path.realpath(std_path)
+        if real_path not in seen_dirs:
+            seen_dirs.add(real_path)
             search_dirs.append(std_path)
     
-    candidates = []
-    for search_dir in search_dirs:
-        try:
-            for idx, candidate in enumerate(search_dir.rglob(name)):
-                if idx > search_depth_limit:
-                    log_warn(
-                        f"Поиск модели '{name}' в {search_dir} достиг лимита {search_depth_limit}; остановка"
-                    )
-                    break
-                candidates.append(candidate)
-        except Exception as exc:
-            log_warn(f"Не удалось обойти {search_dir} при поиске модели {name}: {exc}")
-            continue
+    # Кандидаты перебираются лениво: поиск останавливается на первом подходящем файле
+    candidates = (
+        candidate
+        for search_dir in search_dirs
+        for candidate in _iter_model_candidates(search_dir, name, search_depth_limit)
+    )
+
+    # Один stat на кандидата вместо resolve() (readlink на каждый компонент пути) для него и target:
+    # «тот же файл, что target» — совпадение (st_dev, st_ino)
+    try:
+        target_st = os.stat(target_abs)
+        target_id: Optional[Tuple[int, int]] = (target_st.st_dev, target_st.st_ino)
+    except OSError:
+        target_id = None
 
     for candidate in candidates:
         try:
-            if candidate.resolve() == target_abs.resolve():
-                continue
-        except Exception:
+            candidate_st = os.stat(candidate)
+        except OSError:
             continue
-
-        if not candidate.is_file():
+        if not stat.S_ISREG(candidate_st.st_mode):
+            continue
+        if target_id is not None and (candidate_st.st_dev, candidate_st.st_ino) == target_id:
             continue
 
         if checksum_algo and checksum_hex:
             try:
-                actual = verify_models.compute_checksum(str(candidate), algo=checksum_algo).split(":", 1)[1]
+                actual = _cached_checksum(candidate, checksum_algo)
             except Exception as exc:
                 log_warn(f"Не удалось вычислить checksum для кандидата {candidate}: {exc}")
                 continue
@@ -1462,6 +2132,45 @@ def _find_existing_model(
     return None
 
 
+def _iter_model_candidates(search_dir: pathlib.Path, name: str, limit: int) -> Iterator[pathlib.Path]:
+    """Пути с именем name внутри search_dir (не более limit совпадений).
+
+    Сначала прямые проверки стандартных подкаталогов ComfyUI, затем обход в ширину через os.scandir.
+    Как и rglob, в симлинки на каталоги не заходит.
+    """
+    root = str(search_dir)
+    seen: Set[str] = set()
+    for subdir in ("",) + _DEFAULT_MODEL_SUBDIRS:
+        path = os.path.join(root, subdir, name) if subdir else os.path.join(root, name)
+        if os.path.lexists(path):
+            seen.add(path)
+            yield pathlib.Path(path)
+
+    found = len(seen)
+    pending = deque([root])
+    while pending:
+        current = pending.popleft()
+        try:
+            with os.scandir(current) as it:
+                entries = list(it)
+        except OSError as exc:
+            if current == root:
+                log_warn(f"Не удалось обойти {search_dir} при поиске модели {name}: {exc}")
+            continue
+        for entry in entries:
+            if entry.name == name and entry.path not in seen:
+                found += 1
+                if found > limit:
+                    log_warn(f"Поиск модели '{name}' в {search_dir} достиг лимита {limit}; остановка")
+                    return
+                yield pathlib.Path(entry.path)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+            except OSError:
+                continue
+
+
 PREPARED_MARKER_FILENAME = ".runpod_prepared.json"
 
 
@@ -1471,10 +2180,10 @@ def _prepared_marker_path(comfy_home: pathlib.Path) -> pathlib.Path:
 
 def _load_prepared_marker(comfy_home: pathlib.Path) -> Optional[Dict[str, object]]:
     path = _prepared_marker_path(comfy_home)
-    if not path.exists():
-        return None
     try:
-        return json.loads(path.read_text(encoding="utf-8"))
+        return _json_loads(path.read_bytes())  # type: ignore[return-value]
+    except FileNotFoundError:
+        return None
     except Exception as exc:
         log_warn(f"Не удалось прочитать маркер подготовленного окружения {path}: {exc}")
         return None
@@ -1483,11 +2192,20 @@ def _load_prepared_marker(comfy_home: pathlib.Path) -> Optional[Dict[str, object
 def _save_prepared_marker(comfy_home: pathlib.Path, signature: Dict[str, object]) -> None:
     path = _prepared_marker_path(comfy_home)
     try:
-        path.write_text(json.dumps(signature, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+        path.write_bytes(json_dumps_pretty(signature, sort_keys=True))
     except Exception as exc:
         log_warn(f"Не удалось записать маркер подготовленного окружения {path}: {exc}")
 
 
+# Разделы маркера, которые сравниваются и готовятся независимо
+_SIGNATURE_SECTIONS = ("comfy_sig", "custom_nodes_sig", "python_packages_sig", "models_sig")
+
+
+def _section_hash(data: object) -> str:
+    # Канонический JSON (stdlib, сортировка ключей) — хэш не зависит от наличия orjson
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
 def _signature_from_resolved(resolved: Dict[str, object]) -> Dict[str, object]:
     comfy = resolved.get("comfy") if isinstance(resolved, dict) else {}
     comfy_repo = ""
@@ -1506,15 +2224,29 @@ def _signature_from_resolved(resolved: Dict[str, object]) -> Dict[str, object]:
                 {
                     "repo": str(entry.get("repo") or ""),
                     "commit": str(entry.get("commit") or ""),
+                    "name": str(entry.get("name") or ""),
                 }
             )
-    custom_nodes.sort(key=lambda x: (x.get("repo", ""), x.get("commit", "")))
+    custom_nodes.sort(key=lambda x: (x.get("repo", ""), x.get("commit", ""), x.get("name", "")))
+
+    python_packages = resolved.get("python_packages") if isinstance(resolved, dict) else None
+    models_raw = resolved.get("models") if isinstance(resolved, dict) else None
+    models = [m for m in models_raw if isinstance(m, dict)] if isinstance(models_raw, list) else []
 
     return {
         "version_id": str(resolved.get("version_id") or ""),
-        "comfy": {"repo": comfy_repo, "commit": comfy_commit},
-        "custom_nodes": custom_nodes,
+        "comfy_sig": _section_hash({"repo": comfy_repo, "commit": comfy_commit}),
+        "custom_nodes_sig": _section_hash(custom_nodes),
+        "python_packages_sig": _section_hash(python_packages if isinstance(python_packages, list) else []),
+        "models_sig": _section_hash(sorted(models, key=_section_hash)),
     }
 
 
+def _stale_signature_sections(marker: Optional[Dict[str, object]], signature: Dict[str, object]) -> Set[str]:
+    """Разделы, для которых маркер не совпадает с сигнатурой (маркер другой версии/формата — все)."""
+    if not isinstance(marker, dict) or marker.get("version_id") != signature.get("version_id"):
+        return set(_SIGNATURE_SECTIONS)
+    return {key for key in _SIGNATURE_SECTIONS if marker.get(key) != signature.get(key)}
+
+
 
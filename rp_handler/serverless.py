@@ -6,6 +6,7 @@ import json
 import os
 import pathlib
 import tempfile
+import time
 import urllib.request
 import uuid
 from typing import Any, Dict, Optional
@@ -16,7 +17,7 @@ except Exception as exc:  # pragma: no cover
     raise RuntimeError("runpod package is required for serverless adapter. Install 'runpod'.") from exc
 
 from .workflow import run_workflow
-from .utils import log_info, log_warn, log_error
+from .utils import TRUTHY_VALUES, log_info, log_warn, log_error, read_json_file
 
 
 def _infer_mime_type(extension: str) -> str:
@@ -96,8 +97,7 @@ def _generate_unique_filename(original_filename: str, request_id: Optional[str])
     if request_id:
         prefix = str(request_id).replace("-", "")[:16]  # Ограничить длину
     else:
-        import datetime as dt
-        prefix = dt.datetime.utcnow().strftime("%Y%m%d%H%M%S")
+        prefix = time.strftime("%Y%m%d%H%M%S", time.gmtime())
 
     # Добавить случайные символы для уникальности
     random_part = uuid.uuid4().hex[:8]
@@ -298,7 +298,7 @@ def _apply_unique_filenames_to_workflow(workflow_path: str, filename_mapping: Di
 
     # Загрузить workflow JSON
     try:
-        workflow_data = json.loads(pathlib.Path(workflow_path).read_text(encoding='utf-8'))
+        workflow_data = read_json_file(workflow_path)
     except Exception as exc:
         raise RuntimeError(f"Не удалось прочитать workflow JSON: {exc}") from exc
 
@@ -377,9 +377,7 @@ def _gcs_upload(data: bytes, bucket: str, prefix: Optional[str], extension: str
 
     bucket_obj = client.bucket(bucket)
     # Генерируем имя файла с правильным расширением
-    import datetime as dt
-
-    ts = dt.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    ts = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
     unique = uuid.uuid4().hex[:8]
 
     # Убедимся что extension начинается с точки
@@ -409,7 +407,7 @@ def _gcs_upload(data: bytes, bucket: str, prefix: Optional[str], extension: str
     }
 
     # Optional public-read
-    if str(os.environ.get("GCS_PUBLIC", "")).strip().lower() in {"1", "true", "yes", "on"}:
+    if _bool(os.environ.get("GCS_PUBLIC")):
         try:
             blob.acl.all().grant_read()
             blob.acl.save()
@@ -438,7 +436,7 @@ def _bool(val: Any, default: bool = False) -> bool:
         return default
     if isinstance(val, bool):
         return val
-    return str(val).strip().lower() in {"1", "true", "yes", "on"}
+    return str(val).strip().lower() in TRUTHY_VALUES
 
 
 _DEFAULT_BUILDS_ROOT = "/runpod-volume/builds"
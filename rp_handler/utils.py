@@ -1,10 +1,61 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
+import json
+import mmap
 import os
+import re
 import subprocess
 import sys
-from typing import Dict, List, Optional, Tuple
+import threading
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+try:
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover - orjson опционален
+    orjson = None  # type: ignore[assignment]
+
+
+def json_loads(raw: bytes) -> object:
+    """Разобрать JSON из bytes: orjson (если установлен) или стандартный json."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def json_dumps_pretty(data: object, *, sort_keys: bool = False) -> bytes:
+    """Сериализовать JSON с отступом 2 и переводом строки в конце (UTF-8 bytes)."""
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(data, option=option)
+    return (json.dumps(data, ensure_ascii=False, indent=2, sort_keys=sort_keys) + "\n").encode("utf-8")
+
+
+def read_json_file(path: str) -> object:
+    """
+    Прочитать JSON-файл через mmap.
+    
+    С orjson разбор идёт прямо по отображённой памяти, без промежуточной копии файла.
+    
+    Args:
+        path: Путь к JSON-файлу
+        
+    Returns:
+        Разобранные данные
+    """
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Пустой файл нельзя отобразить — пусть парсер сообщит об ошибке
+            return json_loads(f.read())
+        with mm:
+            if orjson is None:
+                return json.loads(mm[:])
+            with memoryview(mm) as view:
+                return orjson.loads(view)
 
 
 def log_info(msg: str) -> None:
@@ -26,7 +77,8 @@ def run_command(
     cmd: List[str], 
     cwd: Optional[str] = None, 
     env: Optional[Dict[str, str]] = None,
-    timeout: Optional[int] = None
+    timeout: Optional[int] = None,
+    capture: bool = True,
 ) -> Tuple[int, str, str]:
     """
     Выполнить команду и вернуть код возврата, stdout и stderr.
@@ -36,20 +88,26 @@ def run_command(
         cwd: Рабочая директория
         env: Переменные окружения
         timeout: Таймаут выполнения в секундах
+        capture: Перехватывать stdout; при False он отбрасывается (DEVNULL),
+            stderr перехватывается всегда — он нужен для сообщения об ошибке
         
     Returns:
         Tuple[код_возврата, stdout, stderr]
     """
     try:
+        # close_fds=False: дескрипторы Python и так не наследуются (PEP 446),
+        # а обход всех FD до RLIMIT_NOFILE в контейнерах заметно замедляет spawn
         result = subprocess.run(
             cmd,
             cwd=cwd,
             env=env,
-            capture_output=True,
+            stdout=subprocess.PIPE if capture else subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
             text=True,
-            timeout=timeout
+            timeout=timeout,
+            close_fds=False,
         )
-        return result.returncode, result.stdout.strip(), result.stderr.strip()
+        return result.returncode, (result.stdout or "").strip(), result.stderr.strip()
     except subprocess.TimeoutExpired as e:
         log_error(f"Command timed out after {timeout} seconds: {' '.join(cmd)}")
         return -1, "", str(e)
@@ -58,6 +116,72 @@ def run_command(
         return -1, "", str(e)
 
 
+def _drain_tail(stream: "BinaryIO", limit: int, sink: List[str]) -> None:
+    # Читаем поток байтами до EOF, храня только последние limit байт; декодируется лишь хвост.
+    # Невалидный UTF-8 (например, путь в выводе git) не должен остановить чтение pipe
+    tail = b""
+    for chunk in iter(lambda: stream.read(8192), b""):
+        tail = (tail + chunk)[-limit:]
+    sink.append(tail.decode("utf-8", errors="replace"))
+
+
+def run_command_tail(
+    cmd: List[str],
+    cwd: Optional[str] = None,
+    env: Optional[Dict[str, str]] = None,
+    timeout: Optional[int] = None,
+    tail_chars: int = 64_000,
+) -> Tuple[int, str, str]:
+    """
+    То же, что run_command, но от stdout/stderr сохраняется только хвост (tail_chars байт).
+    
+    Для «шумных» команд (git clone и т.п.): вывод вычитывается фоновыми потоками,
+    поэтому pipe не переполняется, а память ограничена tail_chars на поток.
+    
+    Returns:
+        Tuple[код_возврата, хвост stdout, хвост stderr]
+    """
+    try:
+        proc = subprocess.Popen(
+            cmd,
+            cwd=cwd,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=False,
+        )
+    except Exception as e:
+        log_error(f"Command failed: {' '.join(cmd)} - {e}")
+        return -1, "", str(e)
+
+    out_tail: List[str] = []
+    err_tail: List[str] = []
+    readers = [
+        threading.Thread(target=_drain_tail, args=(proc.stdout, tail_chars, out_tail), daemon=True),
+        threading.Thread(target=_drain_tail, args=(proc.stderr, tail_chars, err_tail), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+    try:
+        code = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired as e:
+        proc.kill()
+        proc.wait()
+        log_error(f"Command timed out after {timeout} seconds: {' '.join(cmd)}")
+        return -1, "", str(e)
+    finally:
+        for reader in readers:
+            reader.join()
+    return code, "".join(out_tail).strip(), "".join(err_tail).strip()
+
+
+# $VAR и ${VAR} — те же формы, что понимает os.path.expandvars
+_ENV_VAR_RE = re.compile(r"\$(\w+|\{[^}]*\})", re.ASCII)
+
+# Переменные, которые при заданном extra_env берутся только из него
+_EXPLICIT_ENV_VARS = frozenset({"COMFY_HOME", "MODELS_DIR"})
+
+
 def expand_env_vars(path: str, extra_env: Optional[Dict[str, str]] = None) -> str:
     """
     Развернуть переменные окружения в пути.
@@ -69,14 +193,27 @@ def expand_env_vars(path: str, extra_env: Optional[Dict[str, str]] = None) -> st
     Returns:
         Путь с развернутыми переменными
     """
-    if extra_env:
-        env = os.environ.copy()
-        env.update(extra_env)
-        # Явные подстановки, затем общее развертывание
-        expanded = path.replace("$COMFY_HOME", extra_env.get("COMFY_HOME", ""))
-        expanded = expanded.replace("$MODELS_DIR", extra_env.get("MODELS_DIR", ""))
-        return os.path.expandvars(expanded)
-    return os.path.expandvars(path)
+    if "$" not in path:
+        return path
+
+    def _substitute(match: "re.Match[str]") -> str:
+        name = match.group(1)
+        if name.startswith("{"):
+            name = name[1:-1]
+        if extra_env:
+            # Явные подстановки из extra_env, затем общее окружение
+            if name in _EXPLICIT_ENV_VARS:
+                return extra_env.get(name, "")
+            if name in extra_env:
+                return extra_env[name]
+        value = os.environ.get(name)
+        return match.group(0) if value is None else value
+
+    return _ENV_VAR_RE.sub(_substitute, path)
+
+
+# Строковые значения переменных окружения, считающиеся «истиной»
+TRUTHY_VALUES = frozenset({"1", "true", "yes", "on"})
 
 
 def get_env_bool(name: str, default: bool = False) -> bool:
@@ -93,7 +230,7 @@ def get_env_bool(name: str, default: bool = False) -> bool:
     val = os.environ.get(name)
     if val is None:
         return default
-    return str(val).strip().lower() in {"1", "true", "yes", "on"}
+    return val.strip().lower() in TRUTHY_VALUES
 
 
 def validate_required_path(path: str, description: str) -> None:
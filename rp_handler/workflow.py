@@ -11,7 +11,7 @@ from typing import Deque, Dict, List, Optional, Tuple, IO
 import threading
 from collections import deque
 
-from .utils import log_info, log_warn, log_error, run_command, validate_required_path
+from .utils import log_info, log_warn, log_error, run_command, validate_required_path, read_json_file
 
 # Таймаут ожидания запуска ComfyUI в секундах
 _COMFY_STARTUP_TIMEOUT = int(os.environ.get("COMFY_STARTUP_TIMEOUT", "180"))
@@ -315,7 +315,7 @@ class ComfyUIWorkflowRunner:
             self._wait_for_comfyui()
             
             # 3. Загрузить и отправить workflow
-            workflow_data = json.loads(pathlib.Path(workflow_path).read_text(encoding='utf-8'))
+            workflow_data = read_json_file(workflow_path)
             prompt_id = self._submit_workflow(workflow_data)
             
             if self.verbose:
@@ -23,6 +23,7 @@ import hashlib
 import json
 import os
 import pathlib
+import re
 import shutil
 import subprocess
 import tempfile
@@ -70,15 +71,28 @@ def safe_makedirs(path: str) -> None:
     pathlib.Path(path).mkdir(parents=True, exist_ok=True)
 
 
+# $VAR and ${VAR}, same forms as os.path.expandvars
+_ENV_VAR_RE = re.compile(r"\$(\w+|\{[^}]*\})", re.ASCII)
+
+# Variables that, when extra_env is given, are taken from it only
+_EXPLICIT_ENV_VARS = frozenset({"COMFY_HOME", "MODELS_DIR"})
+
+
 def expand_env(path: str, extra_env: Optional[Dict[str, str]] = None) -> str:
-    if extra_env:
-        env = os.environ.copy()
-        env.update(extra_env)
-        # Explicitly expand known variables first for determinism/flexibility
-        expanded = path.replace("$COMFY_HOME", extra_env.get("COMFY_HOME", ""))
-        expanded = expanded.replace("$MODELS_DIR", extra_env.get("MODELS_DIR", ""))
-        return os.path.expandvars(expanded)
-    return os.path.expandvars(path)
+    # Single regex pass; no per-call copy of os.environ
+    if "$" not in path:
+        return path
+
+    def _substitute(match: "re.Match[str]") -> str:
+        name = match.group(1)
+        if name.startswith("{"):
+            name = name[1:-1]
+        if extra_env and name in _EXPLICIT_ENV_VARS:
+            return extra_env.get(name, "")
+        value = os.environ.get(name)
+        return match.group(0) if value is None else value
+
+    return _ENV_VAR_RE.sub(_substitute, path)
 
 
 def compute_checksum(path: str, algo: str = "sha256", chunk_size: int = 1024 * 1024) -> str:
@@ -4,7 +4,8 @@ Verify and fetch model artifacts declared in a ComfyUI lock file.
 
 Features:
 - Expands env vars in target paths (supports $COMFY_HOME and $MODELS_DIR)
-- Checks file presence and checksum (sha256 preferred; md5 supported)
+- Checks file presence and checksum (sha256 by default; md5 and, with the
+  optional `blake3` package, blake3 supported)
 - Downloads missing artifacts from `source` (http(s), file path, gs:// via gsutil)
 
 Usage example:
@@ -20,9 +21,11 @@ Exit codes:
 from __future__ import annotations
 
 import argparse
+import contextlib
 import dataclasses
+import errno
 import hashlib
-import json
+import mmap
 import os
 import pathlib
 import re
@@ -32,9 +35,24 @@ import sys
 import tempfile
 import urllib.parse
 import urllib.request
-from typing import Dict, Iterable, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import requests  # type: ignore
+    from requests.adapters import HTTPAdapter  # type: ignore
+    from urllib3.util.retry import Retry  # type: ignore
+except ImportError:  # pragma: no cover - requests is optional; urllib is the fallback
+    requests = None  # type: ignore[assignment]
+
+try:
+    import blake3  # type: ignore
+except ImportError:  # pragma: no cover - blake3 checksums need the optional package
+    blake3 = None  # type: ignore[assignment]
 
 from rp_handler.cache import models_cache_dir
+from rp_handler.utils import TRUTHY_VALUES, expand_env_vars, read_json_file
 
 
 # ----------------------------- Small utilities ----------------------------- #
@@ -57,32 +75,67 @@ def safe_makedirs(path: str) -> None:
 
 
 def expand_env(path: str, extra_env: Optional[Dict[str, str]] = None) -> str:
-    if extra_env:
-        env = os.environ.copy()
-        env.update(extra_env)
-        # Explicitly expand known variables first for determinism/flexibility
-        expanded = path.replace("$COMFY_HOME", extra_env.get("COMFY_HOME", ""))
-        expanded = expanded.replace("$MODELS_DIR", extra_env.get("MODELS_DIR", ""))
-        return os.path.expandvars(expanded)
-    return os.path.expandvars(path)
+    # Single regex pass; $COMFY_HOME/$MODELS_DIR come from extra_env for determinism
+    return expand_env_vars(path, extra_env)
 
 
-def compute_checksum(path: str, algo: str = "sha256", chunk_size: int = 1024 * 1024) -> str:
-    h: hashlib._Hash
+def new_hasher(algo: str) -> "hashlib._Hash":
     algo_lower = algo.lower()
     if algo_lower == "sha256":
-        h = hashlib.sha256()
-    elif algo_lower == "md5":
-        h = hashlib.md5()
-    else:
-        raise ValueError(f"Unsupported checksum algorithm: {algo}")
+        return hashlib.sha256()
+    if algo_lower == "md5":
+        return hashlib.md5()
+    if algo_lower == "blake3":
+        if blake3 is None:
+            raise ValueError("blake3 checksums require the 'blake3' package (pip install blake3)")
+        # SIMD + multithreaded tree hashing for large inputs
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+    raise ValueError(f"Unsupported checksum algorithm: {algo}")
+
+
+def _hash_file_into(h: "hashlib._Hash", path: str, chunk_size: int = 1024 * 1024) -> None:
+    if blake3 is not None and isinstance(h, blake3.blake3):
+        # mmap-based, lets blake3 spread the file over all its threads
+        h.update_mmap(path)
+        return
     with open(path, "rb") as f:
         for chunk in iter(lambda: f.read(chunk_size), b""):
             h.update(chunk)
+
+
+# hashlib.file_digest (Python 3.11+) hashes in C with a reusable buffer, no Python-level chunk loop
+_file_digest = getattr(hashlib, "file_digest", None)
+
+# Files above this size are hashed through one mmap'ed update() call
+_MMAP_HASH_THRESHOLD = 64 * 1024 * 1024
+
+
+def _mmap_digest(path: str, algo: str) -> str:
+    h = new_hasher(algo)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)  # aggressive readahead, pages dropped behind
+        # Single update: hashlib releases the GIL and OpenSSL walks the whole mapping
+        h.update(mm)
+    return h.hexdigest()
+
+
+def compute_checksum(path: str, algo: str = "sha256", chunk_size: int = 1024 * 1024) -> str:
+    algo_lower = algo.lower()
+    if algo_lower in ("sha256", "md5") and os.path.getsize(path) > _MMAP_HASH_THRESHOLD:
+        return f"{algo_lower}:{_mmap_digest(path, algo_lower)}"
+    if _file_digest is not None and algo_lower in ("sha256", "md5"):
+        # Unbuffered: file_digest readinto()s its own buffer, a BufferedReader layer adds nothing
+        with open(path, "rb", buffering=0) as f:
+            return f"{algo_lower}:{_file_digest(f, algo_lower).hexdigest()}"
+    h = new_hasher(algo)
+    _hash_file_into(h, path, chunk_size)
     return f"{algo_lower}:{h.hexdigest()}"
 
 
+@lru_cache(maxsize=512)
 def parse_checksum(value: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    # Pure: the same lock strings are parsed on every realize/verify run
     if not value:
         return None, None
     if ":" in value:
@@ -118,10 +171,22 @@ def atomic_copy(src: str, dst: str) -> None:
             pass
 
 
+def atomic_move(src: str, dst: str) -> None:
+    # A temp file we own: rename it into place (no data copy); copy only across filesystems
+    safe_makedirs(str(pathlib.Path(dst).parent))
+    try:
+        os.replace(src, dst)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        atomic_copy(src, dst)
+
+
 def run_command(command: List[str]) -> Tuple[int, str, str]:
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    out, err = proc.communicate()
-    return proc.returncode, out.strip(), err.strip()
+    # close_fds=False avoids scanning every FD up to RLIMIT_NOFILE (slow in containers);
+    # Python-created descriptors are non-inheritable anyway (PEP 446)
+    proc = subprocess.run(command, capture_output=True, text=True, close_fds=False)
+    return proc.returncode, proc.stdout.strip(), proc.stderr.strip()
 
 
 # ----------------------------- Cache management ----------------------------- #
@@ -146,8 +211,9 @@ def cache_enabled(force: Optional[bool] = None) -> bool:
 
 
 def is_offline_mode() -> bool:
+    # Deliberately not cached: `version.py run-handler --offline` toggles COMFY_OFFLINE in-process
     value = os.environ.get("COMFY_OFFLINE") or os.environ.get("COMFY_OFFLINE_MODE")
-    return bool(value and str(value).strip().lower() in {"1", "true", "yes", "on"})
+    return bool(value and value.strip().lower() in TRUTHY_VALUES)
 
 
 def _safe_stem(value: str) -> str:
@@ -260,16 +326,52 @@ def ensure_link_from_cache(cache_path: pathlib.Path, target_path: pathlib.Path)
 # ------------------------------- Downloaders -------------------------------- #
 
 
-def download_http(url: str, dest_path: str, timeout: int = 60, headers: Optional[Dict[str, str]] = None) -> None:
+@lru_cache(maxsize=1)
+def _http_session() -> Optional["requests.Session"]:
+    """Shared pooled session: models from the same host reuse TCP+TLS connections."""
+    if requests is None:
+        return None
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@contextlib.contextmanager
+def _http_stream(
+    url: str, headers: Dict[str, str], timeout: int, chunk_size: int
+) -> Iterator[Tuple[Optional[str], Iterable[bytes]]]:
+    """Open a GET stream; yields (Content-Length header, iterator over body chunks)."""
+    session = _http_session()
+    if session is not None:
+        # identity: save the exact bytes the checksum refers to (as urllib does)
+        stream_headers = {"Accept-Encoding": "identity", **headers}
+        with session.get(url, headers=stream_headers, stream=True, timeout=timeout) as resp:
+            resp.raise_for_status()
+            yield resp.headers.get("Content-Length"), resp.iter_content(chunk_size)
+        return
+    req = urllib.request.Request(url, headers=headers)
+    with urllib.request.urlopen(req, timeout=timeout) as resp:  # nosec - user-controlled URLs expected
+        yield resp.headers.get("Content-Length"), iter(lambda: resp.read(chunk_size), b"")
+
+
+def download_http(
+    url: str,
+    dest_path: str,
+    timeout: int = 60,
+    headers: Optional[Dict[str, str]] = None,
+    hasher: Optional["hashlib._Hash"] = None,
+) -> None:
     req_headers = {"User-Agent": "runpod-comfy-verifier/1.0"}
     if headers:
         req_headers.update(headers)
-    req = urllib.request.Request(url, headers=req_headers)
-    with urllib.request.urlopen(req, timeout=timeout) as resp:  # nosec - user-controlled URLs expected
+    chunk_size = 1024 * 1024  # 1 MB
+    with _http_stream(url, req_headers, timeout, chunk_size) as (total_size, chunks):
         safe_makedirs(str(pathlib.Path(dest_path).parent))
         
         # Получаем размер файла для индикатора прогресса
-        total_size = resp.headers.get("Content-Length")
         total_mb = None
         if total_size:
             try:
@@ -279,15 +381,16 @@ def download_http(url: str, dest_path: str, timeout: int = 60, headers: Optional
         
         with open(dest_path, "wb") as f:
             downloaded = 0
-            chunk_size = 1024 * 1024  # 1 MB
             last_percent = -1
             last_logged_mb = 0
             
-            while True:
-                chunk = resp.read(chunk_size)
+            for chunk in chunks:
                 if not chunk:
-                    break
+                    continue
                 f.write(chunk)
+                if hasher is not None:
+                    # Хэш считается на лету — без второго чтения файла с диска
+                    hasher.update(chunk)
                 downloaded += len(chunk)
                 
                 # Показываем прогресс
@@ -397,41 +500,48 @@ def build_civitai_url(path: str, query: str = "") -> str:
     return base_url
 
 
-def download_civitai(source: str, dest_path: str, timeout: int = 60) -> None:
+def download_civitai(source: str, dest_path: str, timeout: int = 60, hasher: Optional["hashlib._Hash"] = None) -> None:
     path, query = parse_civitai_source(source)
     download_url = build_civitai_url(path, query)
     token = os.environ.get("CIVITAI_TOKEN")
     headers = {"Authorization": f"Bearer {token}"} if token else None
-    download_http(download_url, dest_path, timeout=timeout, headers=headers)
+    download_http(download_url, dest_path, timeout=timeout, headers=headers, hasher=hasher)
 
 
-def download_hf(source: str, dest_path: str, timeout: int = 60) -> None:
+def download_hf(source: str, dest_path: str, timeout: int = 60, hasher: Optional["hashlib._Hash"] = None) -> None:
     repo_id, revision, path_in_repo = parse_hf_source(source)
     resolve_url = build_hf_resolve_url(repo_id, revision, path_in_repo)
     token = os.environ.get("HF_TOKEN")
     headers = {"Authorization": f"Bearer {token}"} if token else None
-    download_http(resolve_url, dest_path, timeout=timeout, headers=headers)
+    download_http(resolve_url, dest_path, timeout=timeout, headers=headers, hasher=hasher)
 
 
-def fetch_to_temp(source: str, tmp_dir: str, timeout: int = 60) -> str:
+def fetch_to_temp(source: str, tmp_dir: str, timeout: int = 60, hasher: Optional["hashlib._Hash"] = None) -> str:
     parsed = urllib.parse.urlparse(source)
     filename = pathlib.Path(parsed.path or "artifact").name or "artifact"
     with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False, prefix=f"dl_{filename}.") as tmp:
         tmp_path = tmp.name
     try:
+        streamed = True
         if parsed.scheme in ("http", "https"):
-            download_http(source, tmp_path, timeout=timeout)
+            download_http(source, tmp_path, timeout=timeout, hasher=hasher)
         elif parsed.scheme in ("file",):
             download_file(source, tmp_path)
+            streamed = False
         elif parsed.scheme in ("gs", "gsutil") or source.startswith("gs://"):
             download_gs(source, tmp_path)
+            streamed = False
         elif parsed.scheme in ("hf", "huggingface"):
-            download_hf(source, tmp_path, timeout=timeout)
+            download_hf(source, tmp_path, timeout=timeout, hasher=hasher)
         elif parsed.scheme in ("civitai",):
-            download_civitai(source, tmp_path, timeout=timeout)
+            download_civitai(source, tmp_path, timeout=timeout, hasher=hasher)
         else:
             # Treat as local filesystem path
             download_file(source, tmp_path)
+            streamed = False
+        if hasher is not None and not streamed:
+            # Copied by an external tool: hash the result once
+            _hash_file_into(hasher, tmp_path)
         return tmp_path
     except Exception:
         # Ensure temp gets removed on error
@@ -443,6 +553,13 @@ def fetch_to_temp(source: str, tmp_dir: str, timeout: int = 60) -> str:
         raise
 
 
+def fetch_to_temp_with_hash(source: str, tmp_dir: str, algo: str, timeout: int = 60) -> Tuple[str, str]:
+    """Fetch like fetch_to_temp and return (tmp_path, hex digest); http sources are hashed while streaming."""
+    hasher = new_hasher(algo)
+    tmp_path = fetch_to_temp(source, tmp_dir=tmp_dir, timeout=timeout, hasher=hasher)
+    return tmp_path, hasher.hexdigest()
+
+
 # --------------------------------- Core ------------------------------------- #
 
 
@@ -455,9 +572,8 @@ class VerifyResult:
 
 
 def load_lock_models(lock_path: str) -> List[Dict[str, object]]:
-    with open(lock_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    models = data.get("models", [])
+    data = read_json_file(lock_path)
+    models = data.get("models", []) if isinstance(data, dict) else None
     if not isinstance(models, list):
         raise ValueError("Invalid lock file format: 'models' must be a list")
     # Normalize fields to str/Optional[str]
@@ -519,15 +635,16 @@ def verify_single_model(model: Dict[str, object], env: Dict[str, str], overwrite
     tmp_parent = str(pathlib.Path(target_path).parent)
     tmp_dir = tempfile.mkdtemp(prefix="verify_models_", dir=tmp_parent)
     try:
-        tmp_download = fetch_to_temp(source, tmp_dir=tmp_dir, timeout=timeout)
-        # Validate checksum if expected
+        # Validate checksum if expected (computed during the download)
         if expected_algo and expected_hex:
-            actual = compute_checksum(tmp_download, algo=expected_algo)
-            if actual.split(":", 1)[1] != expected_hex:
+            tmp_download, actual_hex = fetch_to_temp_with_hash(source, tmp_dir=tmp_dir, algo=expected_algo, timeout=timeout)
+            if actual_hex != expected_hex:
                 return VerifyResult(name=name, target_path=target_path, status="error", message="downloaded checksum mismatch")
+        else:
+            tmp_download = fetch_to_temp(source, tmp_dir=tmp_dir, timeout=timeout)
 
-        # Copy to target
-        atomic_copy(tmp_download, target_path)
+        # Move to target (tmp_dir is next to it, so this is a rename)
+        atomic_move(tmp_download, target_path)
         return VerifyResult(name=name, target_path=target_path, status=("updated" if os.path.exists(target_path) else "downloaded"), message="fetched from source")
     finally:
         try:
@@ -536,7 +653,7 @@ def verify_single_model(model: Dict[str, object], env: Dict[str, str], overwrite
             pass
 
 
-def run_verification(lock_path: str, models_dir: Optional[str], overwrite: bool, timeout: int, verbose: bool) -> int:
+def run_verification(lock_path: str, models_dir: Optional[str], overwrite: bool, timeout: int, verbose: bool, workers: int = 1) -> int:
     env = derive_env(models_dir=models_dir)
     models = load_lock_models(lock_path)
     if not models:
@@ -544,16 +661,37 @@ def run_verification(lock_path: str, models_dir: Optional[str], overwrite: bool,
         return 0
 
     results: List[VerifyResult] = []
-    for m in models:
-        try:
-            res = verify_single_model(m, env=env, overwrite=overwrite, timeout=timeout)
-            results.append(res)
-            if verbose:
-                log_info(f"{res.name}: {res.status} - {res.message}")
-        except Exception as exc:
-            target = str(m.get("target_path")) if isinstance(m.get("target_path"), str) else ""
-            results.append(VerifyResult(name=str(m.get("name")), target_path=target, status="error", message=str(exc)))
-            log_error(f"{m.get('name')}: error - {exc}")
+
+    def _record_error(m: Dict[str, object], exc: Exception) -> None:
+        target = str(m.get("target_path")) if isinstance(m.get("target_path"), str) else ""
+        results.append(VerifyResult(name=str(m.get("name")), target_path=target, status="error", message=str(exc)))
+        log_error(f"{m.get('name')}: error - {exc}")
+
+    # Parallel verification/download (network-bound, each model uses its own temp dir)
+    workers = max(1, min(int(workers), len(models)))
+    if workers == 1:
+        for m in models:
+            try:
+                res = verify_single_model(m, env=env, overwrite=overwrite, timeout=timeout)
+                results.append(res)
+                if verbose:
+                    log_info(f"{res.name}: {res.status} - {res.message}")
+            except Exception as exc:
+                _record_error(m, exc)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            future_to_model = {
+                executor.submit(verify_single_model, m, env, overwrite, timeout): m for m in models
+            }
+            for future in as_completed(future_to_model):
+                m = future_to_model[future]
+                try:
+                    res = future.result()
+                    results.append(res)
+                    if verbose:
+                        log_info(f"{res.name}: {res.status} - {res.message}")
+                except Exception as exc:
+                    _record_error(m, exc)
 
     total = len(results)
     ok = sum(1 for r in results if r.status == "ok")
@@ -574,6 +712,7 @@ def build_arg_parser() -> argparse.ArgumentParser:
     p.add_argument("--overwrite", action="store_true", help="Overwrite existing files if checksum mismatch and source is available")
     p.add_argument("--timeout", type=int, default=120, help="Network timeout in seconds for http(s)/gs downloads")
     p.add_argument("--cache", action="store_true", help="Enable global models cache (default: env-driven)")
+    p.add_argument("--workers", type=int, default=4, help="Number of parallel download workers (default: 4). Use 1 for sequential")
     p.add_argument("--verbose", action="store_true", help="Verbose output (per-model status)")
     return p
 
@@ -588,6 +727,7 @@ def main(argv: Optional[List[str]] = None) -> int:
             overwrite=args.overwrite,
             timeout=args.timeout,
             verbose=args.verbose,
+            workers=args.workers,
         )
     except FileNotFoundError as exc:
         log_error(str(exc))
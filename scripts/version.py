@@ -643,7 +643,7 @@ def cmd_clone(args: argparse.Namespace) -> int:
         return 2
 
     try:
-        spec = json.loads(source_path.read_text(encoding="utf-8"))
+        spec = json.loads(source_path.read_bytes())
     except (json.JSONDecodeError, OSError) as exc:
         print(f"[ERROR] Не удалось прочитать {source_path}: {exc}")
         return 2
@@ -185,3 +185,147 @@ def test_emit_output_unknown_mode():
         emit_output(data=b"x", mode="unknown", out_file=None, gcs_bucket=None, gcs_prefix=None, verbose=False)
 
 
+
+
+def test_emit_output_base64_chunked_to_file(monkeypatch, tmp_path: Path):
+    import rp_handler.output as output_mod
+
+    monkeypatch.setattr(output_mod, "_B64_CHUNK", 6)
+    out_file = tmp_path / "out.txt"
+    data = bytes(range(256)) * 3
+    emit_output(data=data, mode="base64", out_file=str(out_file), gcs_bucket=None, gcs_prefix=None, verbose=False)
+    text = out_file.read_text(encoding="utf-8")
+    assert text == base64.b64encode(data).decode("utf-8")
+
+
+def test_flush_pending_raises_on_failed_upload():
+    import rp_handler.output as output_mod
+
+    def boom():  # type: ignore[no-untyped-def]
+        raise RuntimeError("network down")
+
+    output_mod._PENDING["pref/ok.png"] = output_mod._UPLOAD_POOL.submit(lambda: None)
+    output_mod._PENDING["pref/bad.png"] = output_mod._UPLOAD_POOL.submit(boom)
+    with pytest.raises(RuntimeError) as exc:
+        output_mod.flush_pending(timeout=5)
+    assert "pref/bad.png" in str(exc.value)
+    assert output_mod._PENDING == {}
+    output_mod.flush_pending()
+
+
+def test_do_upload_retries_only_transient_errors(monkeypatch):
+    import rp_handler.output as output_mod
+
+    class HttpError(Exception):
+        def __init__(self, code: int):
+            super().__init__(f"http {code}")
+            self.code = code
+
+    class DummyBlob:
+        name = "pref/x.png"
+
+        def __init__(self, failures):
+            self.failures = list(failures)
+            self.calls = 0
+
+        def upload_from_file(self, fh, size, content_type, rewind):  # type: ignore[no-untyped-def]
+            self.calls += 1
+            assert fh.read() == b"payload" and size == 7
+            if self.failures:
+                raise self.failures.pop(0)
+
+    monkeypatch.setattr(output_mod.time, "sleep", lambda s: None)
+    monkeypatch.setenv("GCS_SIGNED_URL_TTL", "0")
+
+    blob = DummyBlob([HttpError(503), HttpError(429)])
+    output_mod._do_upload(blob, b"payload", "image/png", verbose=False)
+    assert blob.calls == 3
+
+    blob = DummyBlob([HttpError(403)])
+    with pytest.raises(RuntimeError):
+        output_mod._do_upload(blob, b"payload", "image/png", verbose=False)
+    assert blob.calls == 1
+
+
+def test_do_upload_skips_existing_content_addressed_object(monkeypatch):
+    import rp_handler.output as output_mod
+
+    class DummyBlob:
+        name = "pref/abc.png"
+        uploads = 0
+
+        def exists(self):  # type: ignore[no-untyped-def]
+            return True
+
+        def upload_from_file(self, *args, **kwargs):  # type: ignore[no-untyped-def]
+            self.uploads += 1
+
+    monkeypatch.setenv("GCS_SIGNED_URL_TTL", "0")
+    blob = DummyBlob()
+    output_mod._do_upload(blob, b"payload", "image/png", verbose=False, skip_if_exists=True)
+    assert blob.uploads == 0
+    assert "pref/abc.png" in output_mod._UPLOADED
+
+
+def test_emit_output_base64_chunked_to_text_stdout(monkeypatch):
+    import io
+    import rp_handler.output as output_mod
+
+    monkeypatch.setattr(output_mod, "_B64_CHUNK", 6)
+    fake_stdout = io.StringIO()
+    monkeypatch.setattr(output_mod.sys, "stdout", fake_stdout)
+    data = bytes(range(100))
+    emit_output(data=data, mode="base64", out_file=None, gcs_bucket=None, gcs_prefix=None, verbose=False)
+    assert fake_stdout.getvalue() == base64.b64encode(data).decode("ascii") + "\n"
+
+
+def test_do_upload_existing_object_still_made_public(monkeypatch):
+    import rp_handler.output as output_mod
+
+    grants = []
+
+    class DummyACL:
+        def all(self):  # type: ignore[no-untyped-def]
+            return types.SimpleNamespace(grant_read=lambda: grants.append("read"))
+
+        def save(self):  # type: ignore[no-untyped-def]
+            grants.append("save")
+
+    class DummyBlob:
+        name = "pref/def.png"
+        acl = DummyACL()
+        metadata = None
+
+        def exists(self):  # type: ignore[no-untyped-def]
+            return True
+
+        def upload_from_file(self, *args, **kwargs):  # type: ignore[no-untyped-def]
+            raise AssertionError("existing object must not be re-uploaded")
+
+    monkeypatch.setenv("GCS_PUBLIC", "1")
+    monkeypatch.setenv("GCS_SIGNED_URL_TTL", "0")
+    blob = DummyBlob()
+    output_mod._do_upload(blob, b"payload", "image/png", verbose=False, skip_if_exists=True, metadata={"sha": "def"})
+    assert grants == ["read", "save"]
+    assert blob.metadata is None  # метаданные ставятся только при загрузке
+
+
+def test_do_upload_sets_metadata_before_upload(monkeypatch):
+    import rp_handler.output as output_mod
+
+    class DummyBlob:
+        name = "pref/abc.png"
+        metadata = None
+        seen_metadata = None
+
+        def exists(self):  # type: ignore[no-untyped-def]
+            return False
+
+        def upload_from_file(self, *args, **kwargs):  # type: ignore[no-untyped-def]
+            self.seen_metadata = self.metadata
+
+    monkeypatch.setenv("GCS_PUBLIC", "0")
+    monkeypatch.setenv("GCS_SIGNED_URL_TTL", "0")
+    blob = DummyBlob()
+    output_mod._do_upload(blob, b"payload", "image/png", verbose=False, skip_if_exists=True, metadata={"sha": "abc"})
+    assert blob.seen_metadata == {"sha": "abc"}
@@ -1,5 +1,6 @@
 import json
 import os
+import sys
 from pathlib import Path
 
 import pytest
@@ -33,10 +34,12 @@ def test_install_python_packages_builds_pip_args(monkeypatch, tmp_path: Path, ca
     }
 
     # Stub run to avoid invoking pip
-    calls = {"args": None}
+    calls = {"args": None, "requirements": None}
 
-    def fake_run(args, cwd=None, env=None):  # type: ignore[no-untyped-def]
+    def fake_run(args, cwd=None, env=None, capture=True):  # type: ignore[no-untyped-def]
         calls["args"] = args
+        if args[-2] == "-r":
+            calls["requirements"] = Path(args[-1]).read_text(encoding="utf-8")
         return 0, "ok", ""
 
     monkeypatch.setattr(resolver, "run_command", fake_run)
@@ -45,35 +48,33 @@ def test_install_python_packages_builds_pip_args(monkeypatch, tmp_path: Path, ca
 
     assert calls["args"][0].endswith("python") or calls["args"][0].endswith("python3") or calls["args"][0].endswith(".exe")
     assert calls["args"][1:4] == ["-m", "pip", "install"]
-    # Ensure entries are translated
-    s = " ".join(calls["args"][4:])
+    # Ensure entries are translated into the requirements file
+    s = calls["requirements"]
     assert "foo==1.2.3" in s
     assert "bar @ https://example/b.whl" in s
     assert "baz" in s
 
 
-def test_verify_and_fetch_models_invokes_script_if_present(monkeypatch, tmp_path: Path):
-    # Вместо глобального патча pathlib.Path подменяем только exists для конкретного пути,
-    # чтобы не ломать pytest и сторонний код
-    vm = Path("/app/scripts/verify_models.py")
+def test_verify_and_fetch_models_runs_in_process(monkeypatch):
+    called = {"argv": None}
 
-    def fake_exists(self):  # type: ignore[no-untyped-def]
-        return str(self) == str(vm)
+    def fake_main(argv):  # type: ignore[no-untyped-def]
+        called["argv"] = argv
+        return 0
 
-    monkeypatch.setattr(Path, "exists", fake_exists, raising=False)
+    def fail_run(*args, **kwargs):  # type: ignore[no-untyped-def]
+        raise AssertionError("verify_models must not be started as a subprocess")
 
-    # Stub run to capture args
-    called = {"args": None}
-
-    def fake_run(args, cwd=None, env=None):  # type: ignore[no-untyped-def]
-        called["args"] = args
-        return 0, "ok", ""
-
-    monkeypatch.setattr(resolver, "run_command", fake_run)
+    monkeypatch.setattr(resolver.verify_models, "main", fake_main)
+    monkeypatch.setattr(resolver, "run_command", fail_run)
 
     env = {"MODELS_DIR": "/m"}
-    resolver.verify_and_fetch_models(lock_path="/app/scripts/verify_models.py", env=env, verbose=True)
-    assert called["args"][0].endswith("python") or called["args"][0].endswith("python3") or called["args"][0].endswith(".exe")
+    assert resolver.verify_and_fetch_models(lock_path="lock.json", env=env, verbose=True)
+    assert called["argv"][:4] == ["--lock", "lock.json", "--models-dir", "/m"]
+    assert "--verbose" in called["argv"]
+
+    monkeypatch.setattr(resolver.verify_models, "main", lambda argv: 1)
+    assert resolver.verify_and_fetch_models(lock_path="lock.json", env=env, verbose=False) is False
 
 
 def test_apply_lock_and_prepare_smoke(monkeypatch):
@@ -176,3 +177,498 @@ def test_validate_version_spec_python_packages_invalid_type(tmp_path: Path):
     assert "python_packages" in str(exc_info.value)
 
 
+
+
+def test_install_python_packages_shards_across_workers(monkeypatch):
+    lock = {
+        "python": {
+            "packages": [
+                {"name": "foo", "version": "1.2.3"},
+                {"name": "bar", "url": "https://example/b.whl"},
+                {"name": "baz"},
+            ]
+        }
+    }
+
+    calls = []
+
+    def fake_run(args, cwd=None, env=None, capture=True):  # type: ignore[no-untyped-def]
+        if args[1:4] == ["-m", "pip", "install"]:
+            calls.append((args, Path(args[-1]).read_text(encoding="utf-8").splitlines()))
+        return 0, "ok", ""
+
+    monkeypatch.setattr(resolver, "run_command", fake_run)
+    monkeypatch.setattr(resolver, "_PIP_WORKERS", 2)
+
+    resolver.install_python_packages(lock, verbose=False)
+
+    assert len(calls) == 3
+    assert all(args[4] == "--no-deps" for args, _ in calls)
+    installed = sorted(line for _, lines in calls for line in lines)
+    assert installed == ["bar @ https://example/b.whl", "baz", "foo==1.2.3"]
+    # URL-колесо ставится отдельной задачей
+    assert ["bar @ https://example/b.whl"] in [lines for _, lines in calls]
+
+
+def test_load_lock_cached_until_mtime_changes(tmp_path: Path):
+    lock_file = tmp_path / "v.lock.json"
+    lock_file.write_text(json.dumps({"version_id": "a"}), encoding="utf-8")
+    os.utime(lock_file, ns=(1_000_000_000, 1_000_000_000))
+
+    first = resolver.load_lock(str(lock_file))
+    assert first == {"version_id": "a"}
+    assert resolver.load_lock(str(lock_file)) is first
+
+    lock_file.write_text(json.dumps({"version_id": "b"}), encoding="utf-8")
+    os.utime(lock_file, ns=(2_000_000_000, 2_000_000_000))
+    assert resolver.load_lock(str(lock_file)) == {"version_id": "b"}
+
+
+def test_install_python_packages_skips_satisfied(monkeypatch):
+    lock = {"python": {"packages": [{"name": "Foo_Bar", "version": "1.0"}, {"name": "baz"}]}}
+
+    calls = []
+
+    def fake_run(args, cwd=None, env=None, capture=True):  # type: ignore[no-untyped-def]
+        calls.append(args)
+        return 0, "ok", ""
+
+    monkeypatch.setattr(resolver, "run_command", fake_run)
+    monkeypatch.setattr(resolver, "_resolve_python_interpreter", lambda lock, verbose=False: "/py")
+    monkeypatch.setattr(resolver, "_is_current_interpreter", lambda python_exe: True)
+    monkeypatch.setattr(resolver, "_installed_distributions", lambda: {"foo-bar": "1.0", "baz": "2.0"})
+
+    resolver.install_python_packages(lock, verbose=False)
+    assert calls == []
+
+
+def test_expand_env_single_pass(monkeypatch):
+    monkeypatch.setenv("FOO", "bar")
+    monkeypatch.delenv("NOPE", raising=False)
+    extra = {"MODELS_DIR": "/m"}
+    assert resolver.expand_env("$MODELS_DIR/${FOO}/$FOO/$NOPE", extra_env=extra) == "/m/bar/bar/$NOPE"
+    assert resolver.expand_env("$COMFY_HOME/x", extra_env=extra) == "/x"
+    assert resolver.expand_env("plain/path") == "plain/path"
+
+
+def test_apply_lock_and_prepare_skips_when_stamped(monkeypatch, tmp_path: Path):
+    lock_file = tmp_path / "v.lock.json"
+    lock_file.write_text(json.dumps({"python": {"packages": []}}), encoding="utf-8")
+    monkeypatch.setattr(resolver, "applied_cache_dir", lambda: tmp_path)
+    monkeypatch.setenv("COMFY_HOME", str(tmp_path / "comfy"))
+
+    calls = {"install": 0, "verify": 0}
+
+    def fake_install(lock, verbose):  # type: ignore[no-untyped-def]
+        calls["install"] += 1
+        return True
+
+    def fake_verify(lock_path, env, verbose, no_cache):  # type: ignore[no-untyped-def]
+        calls["verify"] += 1
+        return True
+
+    monkeypatch.setattr(resolver, "install_python_packages", fake_install)
+    monkeypatch.setattr(resolver, "verify_and_fetch_models", fake_verify)
+
+    resolver.apply_lock_and_prepare(lock_path=str(lock_file), models_dir=str(tmp_path / "m"), verbose=False)
+    resolver.apply_lock_and_prepare(lock_path=str(lock_file), models_dir=str(tmp_path / "m"), verbose=False)
+    assert calls == {"install": 1, "verify": 1}
+
+    monkeypatch.setenv("COMFY_FORCE_PREPARE", "1")
+    resolver.apply_lock_and_prepare(lock_path=str(lock_file), models_dir=str(tmp_path / "m"), verbose=False)
+    assert calls == {"install": 2, "verify": 2}
+
+
+def test_applied_stamp_changes_with_installer_version(monkeypatch, tmp_path: Path):
+    lock_file = tmp_path / "v.lock.json"
+    lock_file.write_text("{}", encoding="utf-8")
+    monkeypatch.setattr(resolver, "applied_cache_dir", lambda: tmp_path)
+    monkeypatch.setattr(resolver, "_uv_executable", lambda: None)
+    env = {"COMFY_HOME": str(tmp_path / "comfy"), "MODELS_DIR": str(tmp_path / "m")}
+
+    versions = {"out": "3.11.7\npip 24.0"}
+    monkeypatch.setattr(
+        resolver, "run_command", lambda args, cwd=None, env=None, capture=True: (0, versions["out"], "")
+    )
+
+    def stamp():  # type: ignore[no-untyped-def]
+        resolver._toolchain_fingerprint.cache_clear()
+        return resolver._applied_stamp_path(str(lock_file), env, "/venv/bin/python")
+
+    first = stamp()
+    assert stamp() == first
+    versions["out"] = "3.11.7\npip 24.2"  # pip обновлён в целевом venv
+    assert stamp() != first
+    versions["out"] = "3.12.1\npip 24.0"  # venv пересоздан на другом Python
+    assert stamp() != first
+
+
+def test_verify_and_fetch_models_passes_workers(monkeypatch):
+    called = {}
+
+    def fake_main(argv):  # type: ignore[no-untyped-def]
+        called["args"] = argv
+        return 0
+
+    monkeypatch.setattr(resolver.verify_models, "main", fake_main)
+    monkeypatch.setattr(resolver, "_VERIFY_WORKERS", 3)
+
+    assert resolver.verify_and_fetch_models(lock_path="lock.json", env={"MODELS_DIR": "/m"}, verbose=False)
+    args = called["args"]
+    assert args[args.index("--workers") + 1] == "3"
+
+
+def test_pip_install_cmd_prefers_uv_for_venv(monkeypatch, tmp_path: Path):
+    venv_python = tmp_path / ".venv" / "bin" / "python"
+    venv_python.parent.mkdir(parents=True)
+    (tmp_path / ".venv" / "pyvenv.cfg").write_text("home = /usr/bin\n", encoding="utf-8")
+    monkeypatch.setattr(resolver, "_uv_executable", lambda: "/usr/bin/uv")
+
+    assert resolver._pip_install_cmd(str(venv_python)) == ["/usr/bin/uv", "pip", "install", "--python", str(venv_python)]
+    # Не venv — обычный pip
+    assert resolver._pip_install_cmd("/usr/bin/python3") == ["/usr/bin/python3", "-m", "pip", "install"]
+
+
+def test_install_custom_node_dependencies_single_pip_call(monkeypatch, tmp_path: Path):
+    for name in ("node_a", "node_b"):
+        node = tmp_path / "custom_nodes" / name
+        node.mkdir(parents=True)
+        (node / "requirements.txt").write_text("numpy\n", encoding="utf-8")
+    (tmp_path / "custom_nodes" / "node_c").mkdir()
+
+    calls = []
+
+    def fake_run(args, cwd=None, env=None, capture=True):  # type: ignore[no-untyped-def]
+        calls.append(args)
+        return 0, "", ""
+
+    monkeypatch.setattr(resolver, "run_command", fake_run)
+    assert resolver._install_custom_node_dependencies(
+        python_exe="python3", comfy_home=tmp_path, wheels_dir=None, offline=False
+    ) is False
+
+    assert len(calls) == 1
+    assert calls[0].count("-r") == 2
+
+
+def test_install_custom_node_dependencies_includes_spec_packages(monkeypatch, tmp_path: Path):
+    node = tmp_path / "custom_nodes" / "node_a"
+    node.mkdir(parents=True)
+    (node / "requirements.txt").write_text("numpy\n", encoding="utf-8")
+
+    calls = []
+    codes = [0]
+
+    def fake_run(args, cwd=None, env=None, capture=True):  # type: ignore[no-untyped-def]
+        calls.append(args)
+        return codes.pop(0) if codes else 0, "", ""
+
+    monkeypatch.setattr(resolver, "run_command", fake_run)
+    kwargs = dict(python_exe="python3", comfy_home=tmp_path, wheels_dir=None, offline=False)
+    assert resolver._install_custom_node_dependencies(python_packages=["einops==0.8.0"], **kwargs)
+    assert len(calls) == 1 and calls[0][-1] == "einops==0.8.0"
+
+    # Общий вызов упал — нода ставится отдельно, пакеты спецификации остаются вызывающему
+    calls.clear()
+    codes[:] = [1]
+    assert resolver._install_custom_node_dependencies(python_packages=["einops==0.8.0"], **kwargs) is False
+    assert len(calls) == 2 and "einops==0.8.0" not in calls[1]
+
+
+def test_resolve_version_spec_resolves_missing_commits_once(monkeypatch, tmp_path: Path):
+    spec_file = tmp_path / "v.json"
+    spec_file.write_text(json.dumps({
+        "schema_version": 2,
+        "version_id": "v",
+        "comfy": {"repo": "https://example/comfy", "ref": "master"},
+        "custom_nodes": [
+            {"repo": "https://example/a"},
+            {"repo": "https://example/b", "commit": "b" * 40},
+            {"repo": "https://example/a", "name": "a-copy"},
+        ],
+        "models": [],
+    }), encoding="utf-8")
+
+    seen = []
+
+    def fake_ls_remote(repo, ref):  # type: ignore[no-untyped-def]
+        seen.append((repo, ref))
+        return repo[-1] * 40
+
+    monkeypatch.setattr(resolver, "_git_ls_remote", fake_ls_remote)
+    resolved = resolver.resolve_version_spec(spec_file)
+
+    assert sorted(seen) == [("https://example/a", None), ("https://example/comfy", "master")]
+    assert resolved["comfy"]["commit"] == "y" * 40
+    assert [n["commit"] for n in resolved["custom_nodes"]] == ["a" * 40, "b" * 40, "a" * 40]
+
+
+def test_collect_custom_node_requirements_parses_names(tmp_path: Path):
+    node = tmp_path / "custom_nodes" / "node"
+    node.mkdir(parents=True)
+    (node / "requirements.txt").write_text(
+        "# comment\n"
+        "numpy>=1.0\n"
+        "opencv-python-headless\n"
+        "torch == 2.1 ; python_version > '3.8'\n"
+        "scikit-image[all]  # extras\n"
+        "-r other.txt\n"
+        "git+https://github.com/a/b.git\n"
+        "https://example/c.whl\n",
+        encoding="utf-8",
+    )
+
+    assert resolver._collect_custom_node_requirements(tmp_path) == {
+        "node": ["numpy", "opencv_python_headless", "torch", "scikit_image"]
+    }
+
+    mapping, node_files = resolver._scan_custom_nodes(tmp_path)
+    assert mapping == resolver._collect_custom_node_requirements(tmp_path)
+    assert node_files == [("node", str(node / "requirements.txt"))]
+
+
+def test_discard_tree_renames_out_of_the_way(tmp_path: Path):
+    target = tmp_path / "ComfyUI"
+    (target / "sub").mkdir(parents=True)
+    (target / "sub" / "f.txt").write_text("x", encoding="utf-8")
+    stale = tmp_path / "ComfyUI.trash.1.2"
+    stale.mkdir()
+
+    resolver._discard_tree(target)
+
+    assert not target.exists()
+    import threading
+    for thread in threading.enumerate():
+        if thread.name == "discard-tree":
+            thread.join(timeout=5)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_prepare_models_runs_models_in_parallel_and_reraises(monkeypatch, tmp_path: Path):
+    seen = []
+
+    def fake_prepare_one(model, *, models_dir, env_vars, offline_effective, made_dirs):  # type: ignore[no-untyped-def]
+        seen.append(model["name"])
+        if model["name"] == "bad":
+            raise RuntimeError("boom")
+
+    monkeypatch.setattr(resolver, "_prepare_one_model", fake_prepare_one)
+    monkeypatch.setattr(resolver, "_MODEL_WORKERS", 4)
+    models = [{"name": "a"}, {"name": "bad"}, {"name": "c"}, "not-a-dict"]
+
+    with pytest.raises(RuntimeError, match="boom"):
+        resolver._prepare_models(resolved_models=models, models_dir=tmp_path, comfy_home=tmp_path, offline=False)
+    assert sorted(seen) == ["a", "bad", "c"]
+
+
+def test_cached_checksum_reuses_result_until_file_changes(monkeypatch, tmp_path: Path):
+    monkeypatch.setattr(resolver, "cache_root", lambda: tmp_path / "cache")
+    monkeypatch.setattr(resolver, "_CHECKSUMS", None)
+    monkeypatch.setattr(resolver, "_CHECKSUMS_DIRTY", True)  # без atexit-регистрации в тесте
+
+    calls = []
+    real_compute = resolver.verify_models.compute_checksum
+
+    def counting_compute(path, algo="sha256"):  # type: ignore[no-untyped-def]
+        calls.append(path)
+        return real_compute(path, algo=algo)
+
+    monkeypatch.setattr(resolver.verify_models, "compute_checksum", counting_compute)
+    model = tmp_path / "model.bin"
+    model.write_bytes(b"weights")
+
+    first = resolver._cached_checksum(model, "sha256")
+    assert resolver._cached_checksum(model, "sha256") == first
+    assert len(calls) == 1
+
+    model.write_bytes(b"other weights")
+    assert resolver._cached_checksum(model, "sha256") != first
+    assert len(calls) == 2
+
+    resolver._save_checksums()
+    saved = json.loads((tmp_path / "cache" / "checksums.json").read_text(encoding="utf-8"))
+    assert saved[os.path.realpath(model)]["size"] == len(b"other weights")
+
+
+def test_find_existing_model_checks_standard_subdirs_then_walks(tmp_path: Path):
+    models = tmp_path / "models"
+    nested = models / "custom" / "deep"
+    nested.mkdir(parents=True)
+    (nested / "m.safetensors").write_bytes(b"nested")
+    (models / "loras").mkdir()
+    (models / "loras" / "m.safetensors").write_bytes(b"lora")
+
+    assert list(resolver._iter_model_candidates(models, "m.safetensors", 1000)) == [
+        models / "loras" / "m.safetensors",
+        nested / "m.safetensors",
+    ]
+
+    found = resolver._find_existing_model(
+        models_dir=models,
+        target_abs=models / "checkpoints" / "m.safetensors",
+        checksum_algo=None,
+        checksum_hex=None,
+    )
+    assert found == models / "loras" / "m.safetensors"
+
+
+def test_stale_signature_sections_only_reports_changed_parts():
+    resolved = {
+        "version_id": "v",
+        "comfy": {"repo": "https://example/comfy", "commit": "a" * 40},
+        "custom_nodes": [{"repo": "https://example/n", "commit": "b" * 40}],
+        "models": [{"name": "m", "target_path": "$MODELS_DIR/m", "source": "hf://o/r/m"}],
+    }
+    marker = resolver._signature_from_resolved(resolved)
+    assert resolver._stale_signature_sections(marker, marker) == set()
+
+    changed = dict(resolved, models=[{"name": "m2", "target_path": "$MODELS_DIR/m2"}])
+    assert resolver._stale_signature_sections(marker, resolver._signature_from_resolved(changed)) == {"models_sig"}
+
+    # Маркер старого формата/другой версии — готовим всё
+    assert resolver._stale_signature_sections(None, marker) == set(resolver._SIGNATURE_SECTIONS)
+    legacy = {"version_id": "v", "comfy": {}, "custom_nodes": []}
+    assert resolver._stale_signature_sections(legacy, marker) == set(resolver._SIGNATURE_SECTIONS)
+
+
+def test_write_extra_model_paths_skips_identical_rewrite(tmp_path: Path):
+    models_dir = tmp_path / "models"
+    resolved_models = [{"target_path": "loras/sub/x.safetensors"}]
+    resolver._write_extra_model_paths(comfy_home=tmp_path, models_dir=models_dir, resolved_models=resolved_models)
+    extra_yaml = tmp_path / "extra_model_paths.yaml"
+    content = extra_yaml.read_text(encoding="utf-8")
+    assert content.startswith("comfyui:\n")
+    assert f"  loras/sub: {models_dir / 'loras' / 'sub'}\n" in content
+
+    os.utime(extra_yaml, ns=(0, 0))
+    resolver._write_extra_model_paths(comfy_home=tmp_path, models_dir=models_dir, resolved_models=resolved_models)
+    assert extra_yaml.stat().st_mtime_ns == 0
+
+
+def test_prepare_node_cache_skips_git_when_commit_checked_out(monkeypatch, tmp_path: Path):
+    commit = "c" * 40
+    cache_path = tmp_path / "node@c"
+    (cache_path / ".git").mkdir(parents=True)
+    (cache_path / ".git" / "HEAD").write_text(commit + "\n", encoding="ascii")
+
+    calls = []
+
+    def fake_run(args, cwd=None, env=None, capture=True):  # type: ignore[no-untyped-def]
+        calls.append(args)
+        return 0, "", ""
+
+    monkeypatch.setattr(resolver, "run_command", fake_run)
+    assert resolver._prepare_node_cache("https://example/node", commit, "node", cache_path, False)
+    assert calls == []
+
+    (cache_path / ".git" / "HEAD").write_text("ref: refs/heads/main\n", encoding="ascii")
+    assert resolver._prepare_node_cache("https://example/node", commit, "node", cache_path, False)
+    # commit уже есть (cat-file -e успешен) — fetch не нужен, только checkout
+    assert [args[3] for args in calls] == ["cat-file", "checkout"]
+
+
+def test_link_model_prefers_hardlink_and_falls_back_to_symlink(monkeypatch, tmp_path: Path):
+    src = tmp_path / "cache" / "model.safetensors"
+    src.parent.mkdir()
+    src.write_bytes(b"weights")
+
+    dst = tmp_path / "models" / "a.safetensors"
+    dst.parent.mkdir()
+    assert resolver._link_model(src, dst) == "hardlink"
+    assert not dst.is_symlink() and dst.stat().st_ino == src.stat().st_ino
+
+    def cross_device(src, dst):  # type: ignore[no-untyped-def]
+        raise OSError(resolver.errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(resolver.os, "link", cross_device)
+    other = tmp_path / "models" / "b.safetensors"
+    assert resolver._link_model(src, other) == "symlink"
+    assert other.is_symlink() and other.read_bytes() == b"weights"
+
+
+def test_realize_prepares_everything_when_venv_missing(monkeypatch, tmp_path: Path):
+    comfy_home = tmp_path / "comfy"
+    comfy_home.mkdir()
+    (comfy_home / "main.py").write_text("", encoding="utf-8")
+    resolved = {
+        "version_id": "v",
+        "comfy": {"repo": "https://example/comfy", "commit": "a" * 40},
+        "custom_nodes": [],
+        "models": [{"name": "m", "target_path": "$MODELS_DIR/m", "source": "hf://o/r/m"}],
+    }
+    # Маркер отличается только моделями, а .venv отсутствует
+    old = dict(resolved, models=[{"name": "m0", "target_path": "$MODELS_DIR/m0", "source": "hf://o/r/m0"}])
+    resolver._save_prepared_marker(comfy_home, resolver._signature_from_resolved(old))
+
+    checkouts = []
+    monkeypatch.setattr(resolver, "resolved_cache_dir", lambda: tmp_path / "resolved")
+    monkeypatch.setattr(resolver, "_nodes_cache_root", lambda: tmp_path / "nodes")
+    monkeypatch.setattr(resolver, "_ensure_repo_cache", lambda repo, offline, commit=None: tmp_path / "cache")
+    monkeypatch.setattr(resolver, "_checkout_from_cache", lambda **kwargs: checkouts.append(kwargs["commit"]))
+    monkeypatch.setattr(resolver, "_ensure_comfy_venv", lambda home, verbose=False: "python3")
+    monkeypatch.setattr(resolver, "_prepare_models", lambda **kwargs: None)
+    monkeypatch.setattr(resolver, "_verify_custom_node_requirements", lambda **kwargs: None)
+
+    resolver.realize_from_resolved(resolved, target_path=comfy_home, models_dir_override=tmp_path / "models")
+
+    assert checkouts == ["a" * 40]
+    marker = resolver._load_prepared_marker(comfy_home)
+    assert resolver._stale_signature_sections(marker, resolver._signature_from_resolved(resolved)) == set()
+
+
+def test_realize_reprepares_only_stale_sections_on_ready_build(monkeypatch, tmp_path: Path):
+    comfy_home = tmp_path / "comfy"
+    venv_python = resolver._venv_python_path(comfy_home / ".venv")
+    venv_python.parent.mkdir(parents=True)
+    venv_python.write_text("", encoding="utf-8")
+    venv_python.chmod(0o755)
+    (comfy_home / "main.py").write_text("", encoding="utf-8")
+    (comfy_home / "requirements.txt").write_text("torch\n", encoding="utf-8")
+    resolved = {
+        "version_id": "v",
+        "comfy": {"repo": "https://example/comfy", "commit": "a" * 40},
+        "custom_nodes": [],
+        "python_packages": ["pkg==1.0"],
+        "models": [{"name": "m", "target_path": "$MODELS_DIR/m", "source": "hf://o/r/m"}],
+    }
+    # Готовый build, маркер отличается только моделями
+    old = dict(resolved, models=[{"name": "m0", "target_path": "$MODELS_DIR/m0", "source": "hf://o/r/m0"}])
+    resolver._save_prepared_marker(comfy_home, resolver._signature_from_resolved(old))
+
+    checkouts, commands, prepared = [], [], []
+    monkeypatch.setattr(resolver, "resolved_cache_dir", lambda: tmp_path / "resolved")
+    monkeypatch.setattr(resolver, "_nodes_cache_root", lambda: tmp_path / "nodes")
+    monkeypatch.setattr(resolver, "_ensure_repo_cache", lambda repo, offline, commit=None: checkouts.append(repo))
+    monkeypatch.setattr(resolver, "_checkout_from_cache", lambda **kwargs: checkouts.append(kwargs["commit"]))
+    monkeypatch.setattr(resolver, "run_command", lambda args, **kwargs: commands.append(args) or (0, "", ""))
+    monkeypatch.setattr(resolver, "_prepare_models", lambda **kwargs: prepared.append(kwargs["resolved_models"]))
+    monkeypatch.setattr(resolver, "_verify_custom_node_requirements", lambda **kwargs: None)
+
+    resolver.realize_from_resolved(resolved, target_path=comfy_home, models_dir_override=tmp_path / "models")
+
+    assert prepared == [resolved["models"]]
+    assert checkouts == []
+    assert commands == []
+    marker = resolver._load_prepared_marker(comfy_home)
+    assert resolver._stale_signature_sections(marker, resolver._signature_from_resolved(resolved)) == set()
+
+
+def test_repo_cache_is_current_ignores_ttl_for_missing_commit(monkeypatch, tmp_path: Path):
+    cache_path = tmp_path / "comfy"
+    (cache_path / ".git").mkdir(parents=True)
+    (cache_path / resolver._FETCH_STAMP_NAME).touch()  # fetch был только что
+
+    monkeypatch.setattr(resolver, "run_command", lambda args, cwd=None, env=None, capture=True: (1, "", ""))
+    assert resolver._repo_cache_is_current(cache_path, None)
+    # Новый pin отсутствует в кеше — свежий штамп не спасает, нужен fetch
+    assert not resolver._repo_cache_is_current(cache_path, "d" * 40)
+
+
+def test_run_command_tail_survives_invalid_utf8():
+    # Больше буфера pipe: при остановленном чтении процесс бы завис
+    script = "import sys; sys.stdout.buffer.write(b'\\xff\\xfe' * 100000 + b'end'); sys.stderr.buffer.write(b'\\xc3(')"
+    code, out, err = resolver.run_command_tail([sys.executable, "-c", script], timeout=30, tail_chars=16)
+
+    assert code == 0
+    assert out.endswith("end")
+    assert err == "�("